@@ -28,15 +28,26 @@ from config import INDEX_DB
 log = None
 
 
+# How much the popularity prior can boost the text score. A book with
+# the most downloads gets its text score multiplied by `1 + PRIOR_WEIGHT`;
+# one with no downloads keeps its text score as is
+PRIOR_WEIGHT = 1.0
+
+
 # Search ranking function
 # Adapted from http://goo.gl/4QXj25 and http://goo.gl/fWg25i
-def make_rank_func(weights):
+def make_rank_func(weights, prior_weight=PRIOR_WEIGHT):
     """`weights` is a list or tuple of the relative ranking per column.
 
     Use floats (1.0 not 1) for more accurate results. Use 0 to ignore a
     column.
+
+    The returned function takes the document's popularity `prior`
+    (0.0-1.0, see `index.py`) as a second argument and uses it to
+    scale the text score. Textually equal matches are thus ordered by
+    popularity.
     """
-    def rank(matchinfo):
+    def rank(matchinfo, prior):
         # matchinfo is defined as returning 32-bit unsigned integers
         # in machine byte order
         # http://www.sqlite.org/fts3.html#matchinfo
@@ -44,10 +55,14 @@ def make_rank_func(weights):
         bufsize = len(matchinfo)  # Length in bytes.
         matchinfo = [struct.unpack(b'I', matchinfo[i:i+4])[0]
                      for i in range(0, bufsize, 4)]
+        # One (hits this row, hits all rows, docs with hits) triple
+        # per column per phrase, so weights repeat for each phrase
+        columns = matchinfo[1]
         it = iter(matchinfo[2:])
-        return sum(x[0]*w/x[1]
-                   for x, w in zip(zip(it, it, it), weights)
-                   if x[1])
+        score = sum(x[0]*weights[i % columns]/x[1]
+                    for i, x in enumerate(zip(it, it, it))
+                    if x[1])
+        return score * (1.0 + prior_weight * (prior or 0.0))
     return rank
 
 
@@ -81,16 +96,19 @@ def main(wf):
     db = sqlite3.connect(INDEX_DB)
     # Set ranking function with weightings for each column.
     # `make_rank_function` must be called with a tuple/list of the same
-    # length as the number of columns "selected" from the database.
-    # In this case, `url` is set to 0 because we don't want to search on
-    # that column
-    db.create_function('rank', 1, make_rank_func((1.0, 1.0, 0)))
+    # length as the number of columns in the `books` table.
+    # In this case, `id` and `url` are set to 0 because we don't want
+    # to search on those columns. The second argument is the book's
+    # popularity prior
+    db.create_function('rank', 2, make_rank_func((0, 1.0, 1.0, 0)))
     cursor = db.cursor()
     try:
         cursor.execute("""SELECT author, title, url FROM
-                            (SELECT rank(matchinfo(books))
+                            (SELECT rank(matchinfo(books), priors.prior)
                              AS r, author, title, url
-                             FROM books WHERE books MATCH ?)
+                             FROM books LEFT JOIN priors
+                             ON priors.docid = books.docid
+                             WHERE books MATCH ?)
                           ORDER BY r DESC LIMIT 100""", (query,))
         results = cursor.fetchall()
     except sqlite3.OperationalError as err:
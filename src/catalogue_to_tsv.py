@@ -38,6 +38,7 @@ title_tag = '//{}title'.format(NS_DC)
 author_tag = '//{}creator/{}agent/{}name'.format(NS_DC, NS_PG, NS_PG)
 book_id_tag = '//{}isFormatOf'.format(NS_DC)
 book_id_attrib = '{}resource'.format(NS_RDF)
+downloads_tag = '//{}downloads'.format(NS_PG)
 
 
 def iter_books(dirpath):
@@ -70,6 +71,12 @@ def parse_book(path):
     id_ = elems[0].attrib[book_id_attrib]
     data['url'] = 'http://www.gutenberg.org/{}'.format(id_)
     data['id'] = id_.split('/')[1]
+    # Download count for the last 30 days. Used as a popularity prior
+    # by the indexer, so missing or junk values just count as 0
+    try:
+        data['downloads'] = int(tree.findtext(downloads_tag))
+    except (TypeError, ValueError):
+        data['downloads'] = 0
     return data
 
 
@@ -86,7 +93,7 @@ def main():
         for k, v in book.items():
             book[k] = unicode(v).encode('utf-8')
         writer.writerow((book['id'], book['author'],
-                         book['title'], book['url']))
+                         book['title'], book['url'], book['downloads']))
 
 
 if __name__ == '__main__':
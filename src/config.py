@@ -17,5 +17,7 @@ from workflow import Workflow
 
 wf = Workflow()
 
-INDEX_DB = wf.cachefile('index.db')
+# Bump the version when the index schema changes, so the index
+# is rebuilt instead of being queried with the wrong schema
+INDEX_DB = wf.cachefile('index.3.db')
 DATA_FILE = wf.workflowfile('books.tsv')
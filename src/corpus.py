@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import print_function, unicode_literals
+
+import re
+import string
+from array import array
+from bisect import bisect_left, insort
+from itertools import islice
+
+import text
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+# Anchor characters in a name
+INITIALS = string.ascii_uppercase + string.digits
+
+# Split on non-letters, numbers
+split_on_delimiters = re.compile('[^a-zA-Z0-9]').split
+
+# Bit for each lower-case ASCII letter and digit in a `charmask`
+CHAR_BITS = dict((c, 1 << i) for i, c in
+                 enumerate(string.ascii_lowercase + string.digits))
+# Bit for all other characters (except space, which queries never
+# contain)
+OTHER_BIT = 1 << len(CHAR_BITS)
+
+# Typecode of `View.masks`, which needs at least 64-bit integers.
+# 'Q' only exists from Python 3.3, but 'L' is 64 bits on 64-bit Unix
+try:
+    MASK_TYPECODE = str('Q')
+    array(MASK_TYPECODE)
+except ValueError:
+    MASK_TYPECODE = str('L')
+
+
+# Length of the n-grams in an `NgramIndex`
+NGRAM_SIZE = 3
+
+
+def charmask(text):
+    """Return bitmask of the characters in lower-case ``text``.
+
+    If every character of a query is in a search key, every bit of the
+    query's mask is set in the search key's mask. The reverse isn't
+    necessarily true (e.g. ``é`` and ``-`` share :const:`OTHER_BIT`),
+    so masks can only rule out search keys, not match them.
+
+    :param text: lower-case text
+    :type text: ``unicode``
+    :rtype: ``int``
+
+    """
+    mask = 0
+    for c in set(text):
+        if c != ' ':
+            mask |= CHAR_BITS.get(c, OTHER_BIT)
+    return mask
+
+
+class NgramIndex(object):
+    """Inverted index of the n-grams in a list of strings.
+
+    For each n-gram, :attr:`postings` holds the sorted indices of the
+    strings that contain it, as an :class:`~array.array` of unsigned
+    integers.
+
+    :param texts: strings to index
+    :type texts: iterable
+    :param n: length of n-grams
+    :type n: ``int``
+
+    """
+
+    def __init__(self, texts=(), n=NGRAM_SIZE):
+        self.n = n
+        self.postings = {}
+        self.size = 0
+        for s in texts:
+            self.append(s)
+
+    def grams(self, s):
+        """Return set of the n-grams in ``s``"""
+        return set([s[j:j + self.n] for j in range(len(s) - self.n + 1)])
+
+    def append(self, s):
+        """Index ``s`` as the next string"""
+        for gram in self.grams(s):
+            postings = self.postings.get(gram)
+            if postings is None:
+                postings = self.postings[gram] = array(str('I'))
+            postings.append(self.size)
+        self.size += 1
+
+    def replace(self, i, old, new):
+        """Re-index string ``i``, which has changed from ``old`` to
+        ``new``. Only the postings of n-grams that changed are touched.
+        """
+        old, new = self.grams(old), self.grams(new)
+        for gram in old - new:
+            postings = self.postings[gram]
+            del postings[bisect_left(postings, i)]
+            if not postings:
+                del self.postings[gram]
+        for gram in new - old:
+            postings = self.postings.get(gram)
+            if postings is None:
+                postings = self.postings[gram] = array(str('I'))
+            insort(postings, i)
+
+    def search(self, query, start=0, stop=None):
+        """Return indices of strings that contain all n-grams of ``query``.
+
+        Only strings ``start`` to ``stop`` are returned. If ``query``
+        is a substring of a string, that string is returned, but not
+        every string returned contains ``query``.
+
+        ``query`` must be at least :attr:`n` characters long.
+
+        :rtype: ``list`` of ``int``
+
+        """
+        if stop is None:
+            stop = self.size
+        postings = []
+        for gram in self.grams(query):
+            if gram not in self.postings:
+                return []
+            postings.append(self.postings[gram])
+        # Check the shortest list's entries against the others
+        postings.sort(key=len)
+        first = postings[0]
+        hits = first[bisect_left(first, start):bisect_left(first, stop)]
+        for other in postings[1:]:
+            hits = [i for i in hits if _contains(other, i)]
+            if not hits:
+                break
+        return list(hits)
+
+
+def _contains(postings, i):
+    """Whether sorted ``postings`` contains ``i``"""
+    j = bisect_left(postings, i)
+    return j < len(postings) and postings[j] == i
+
+
+class View(object):
+    """Search keys in one form (as-is or ASCII-folded) plus everything
+    the ``MATCH_*`` rules derive from them.
+
+    Each attribute is a list with one entry per item:
+
+    - ``values``: the search key
+    - ``lowers``: ``values`` in lower case
+    - ``capitals``: capital letters and digits of the search key,
+      lower-cased (for ``MATCH_CAPITALS``)
+    - ``atoms``: lower-case "atoms" of the search key joined and
+      surrounded by spaces, so ``' {query} ' in atoms`` tests whether
+      ``query`` is an atom (for ``MATCH_ATOM``)
+    - ``initials``: first letters of the atoms (for ``MATCH_INITIALS``)
+    - ``masks``: :func:`charmask` of ``lowers``. An :class:`~array.array`,
+      so :meth:`candidates` can check them all at once with NumPy
+    - ``initial_masks``: :func:`charmask` of ``capitals`` and
+      ``initials``
+
+    If ``ngrams`` is ``True``, :meth:`ngram_index` returns an
+    :class:`NgramIndex` of ``lowers``.
+
+    """
+
+    def __init__(self, ngrams=False):
+        self.values = []
+        self.lowers = []
+        self.capitals = []
+        self.atoms = []
+        self.initials = []
+        self.masks = array(MASK_TYPECODE)
+        self.initial_masks = array(MASK_TYPECODE)
+        self.ngrams = ngrams
+        self._ngram_index = None
+
+    @staticmethod
+    def entry(value):
+        """Return entry for search key ``value``: a tuple of its value
+        for each attribute, in the order of :meth:`get`"""
+        lower = value.lower()
+        atoms = [s.lower() for s in split_on_delimiters(value) if s]
+        capitals = ''.join([c for c in value if c in INITIALS]).lower()
+        initials = ''.join([s[0] for s in atoms])
+        return (value, lower, capitals, ' ' + ' '.join(atoms) + ' ',
+                initials, charmask(lower), charmask(capitals + initials))
+
+    def get(self, i):
+        """Return entry ``i`` (see :meth:`entry`)"""
+        return (self.values[i], self.lowers[i], self.capitals[i],
+                self.atoms[i], self.initials[i], self.masks[i],
+                self.initial_masks[i])
+
+    def append(self, value):
+        """Add search key ``value``"""
+        self.add(self.entry(value))
+
+    def add(self, entry):
+        """Add ``entry`` (see :meth:`entry`)"""
+        for column, x in zip(self._columns(), entry):
+            column.append(x)
+        if self._ngram_index is not None:
+            self._ngram_index.append(entry[1])
+
+    def set(self, i, entry):
+        """Replace entry ``i`` with ``entry`` (see :meth:`entry`)"""
+        if self._ngram_index is not None:
+            self._ngram_index.replace(i, self.lowers[i], entry[1])
+        for column, x in zip(self._columns(), entry):
+            column[i] = x
+
+    def copy_from(self, other, i):
+        """Add ``other``'s entry ``i``. Shares rather than copies it"""
+        self.add(other.get(i))
+
+    def _columns(self):
+        """Return attributes in the order of :meth:`entry`"""
+        return (self.values, self.lowers, self.capitals, self.atoms,
+                self.initials, self.masks, self.initial_masks)
+
+    def ngram_index(self):
+        """Return :class:`NgramIndex` of ``lowers`` or ``None`` if this
+        view doesn't use one. The index is built on the first call."""
+        if self.ngrams and self._ngram_index is None:
+            self._ngram_index = NgramIndex(self.lowers)
+        return self._ngram_index
+
+    def candidates(self, mask, start=0, stop=None, masks=None):
+        """Return indices of entries that may contain the characters in
+        ``mask``.
+
+        Only entries ``start`` to ``stop`` are checked. This is a single
+        vectorised operation if NumPy is installed.
+
+        :param mask: :func:`charmask` of a query
+        :type mask: ``int``
+        :param masks: masks to check instead of :attr:`masks`, e.g.
+            :attr:`initial_masks`
+        :type masks: :class:`~array.array`
+        :rtype: ``list`` of ``int``
+
+        """
+        if masks is None:
+            masks = self.masks
+        if stop is None:
+            stop = len(masks)
+        if numpy is not None and stop > start:
+            # A view of the array's buffer, not a copy
+            masks = numpy.frombuffer(masks,
+                                     dtype='u{}'.format(masks.itemsize))
+            masks = masks[start:stop]
+            hits = numpy.flatnonzero((masks & mask) == mask)
+            return (hits + start).tolist()
+        return [i for i, m in enumerate(islice(masks, start, stop), start)
+                if m & mask == mask]
+
+
+class PreparedCorpus(object):
+    """Search keys of a dataset, prepared once for filtering.
+
+    Everything `IterFilter` needs to know about an item's search key
+    is calculated here once, instead of for every item on every query.
+
+    Entry ``i`` of :attr:`raw` and :attr:`folded` is the search key of
+    ``items[i]``, so corpora of the same data with different ``key``
+    functions line up. Items whose search key is empty can never match:
+    their masks are 0, so :meth:`View.candidates` never returns them.
+
+    :param data: items to prepare
+    :type data: iterable
+    :param key: function to get search key from an item. Must return
+        a ``unicode`` string.
+    :type key: ``callable``
+    :param ngrams: give the views an :class:`NgramIndex` (built when
+        first used)
+    :type ngrams: ``Boolean``
+
+    """
+
+    def __init__(self, data, key=lambda x: x, ngrams=False):
+        #: Items in the order of `data`
+        self.items = []
+        #: Search keys as they are
+        self.raw = View(ngrams)
+        #: Search keys folded to ASCII. Entries for search keys that
+        #: are already ASCII are shared with :attr:`raw`
+        self.folded = View(ngrams)
+        for item in data:
+            self.append(item, key(item))
+
+    def __len__(self):
+        return len(self.items)
+
+    def append(self, item, value):
+        """Add ``item`` with search key ``value``"""
+        value = value.strip()
+        self.items.append(item)
+        self.raw.append(value)
+        if text.isascii(value):
+            self.folded.copy_from(self.raw, len(self.items) - 1)
+        else:
+            self.folded.append(text.fold_to_ascii(value))
+
+    def replace(self, i, item, value):
+        """Replace item ``i`` with ``item`` with search key ``value``"""
+        value = value.strip()
+        self.items[i] = item
+        self.raw.set(i, View.entry(value))
+        if text.isascii(value):
+            self.folded.set(i, self.raw.get(i))
+        else:
+            self.folded.set(i, View.entry(text.fold_to_ascii(value)))
+
+    def remove(self, i):
+        """Remove item ``i``.
+
+        Its entries are replaced with those of an empty search key,
+        which never match, so the indices of later items don't change.
+
+        """
+        self.replace(i, None, '')
@@ -2,22 +2,190 @@
 # encoding: utf-8
 from __future__ import print_function, unicode_literals
 
+import re
 import sqlite3
 import struct
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from itertools import islice
 from os import path
 
+try:
+    from Queue import Empty, Queue
+except ImportError:  # pragma: no cover
+    from queue import Empty, Queue
+
+# PRAGMAs `FTSDatabase.create` sets while it fills a new database.
+# Without syncs, the file is only at risk if the OS crashes, not if
+# the process is killed. The journal stays on disk, so a batch that
+# was being committed is rolled back
+BUILD_PRAGMAS = (
+    ('synchronous', 'OFF'),
+    ('temp_store', 'MEMORY'),
+)
+
+# Table that lists the tables `FTSDatabase` has finished building.
+# Each batch of rows is committed, so a build that's interrupted, e.g.
+# because Alfred killed the process, leaves part of a table, which is
+# built again instead of used
+BUILT_TABLE = 'built_tables'
+
+# With ``memory='auto'``, database files up to this size are copied
+# into memory. Bigger ones are memory-mapped instead. Copying takes
+# about 4ms per MB, and a search of a memory-mapped file about 1ms,
+# so it only pays off if the process runs many searches
+MEMORY_MAX_SIZE = 4 * 1024 * 1024
+# Maximum number of bytes of a database file SQLite memory-maps
+MMAP_SIZE = 256 * 1024 * 1024
+
+# Collection names are used as table names in SQL
+COLLECTION_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# Result of one query of `FTSDatabase.search_many`. ``elapsed`` is in
+# seconds, ``error`` the message of the error the query raised, if any
+QueryResult = namedtuple('QueryResult', 'query rows elapsed error')
+
+
+def unicode61_tokenizer(remove_diacritics=True):
+    """Return ``tokenize`` argument for SQLite's ``unicode61`` tokenizer.
+
+    ``unicode61`` case-folds all of Unicode (``simple`` only folds
+    ASCII) and can remove diacritics, so ``muller`` matches "Müller".
+    Folding happens in SQLite, both when rows are indexed and in
+    ``MATCH`` queries.
+
+    ``remove_diacritics=2`` (SQLite 3.27+) also handles characters
+    with several diacritics; older versions get ``1``.
+
+    :param remove_diacritics: fold characters to their ASCII base
+    :type remove_diacritics: ``Boolean``
+    :returns: tokenizer spec or ``None`` if SQLite is older than 3.7.13
+        and has no ``unicode61`` tokenizer
+    :rtype: ``unicode``
+
+    """
+    if sqlite3.sqlite_version_info < (3, 7, 13):
+        return None
+    option = 0
+    if remove_diacritics:
+        option = 2 if sqlite3.sqlite_version_info >= (3, 27, 0) else 1
+    return 'unicode61 "remove_diacritics={}"'.format(option)
+
+
+# Tokenizer that folds case and diacritics, if SQLite has one
+FOLDING_TOKENIZER = unicode61_tokenizer() or 'simple'
+
 
 class FTSDatabase(object):
-    def __init__(self, data, file=None):
+    """Full-text search database of ``data``.
+
+    If ``file`` is given, the database is built there the first time,
+    and reused afterwards. ``memory`` says whether to copy a database
+    file into memory when it's opened: ``True``, ``False`` (the
+    default) or ``'auto'`` for files no bigger than
+    :const:`MEMORY_MAX_SIZE`. Otherwise the file is memory-mapped,
+    which is cheaper for a process that only runs a few searches, like
+    a workflow run by Alfred for each keystroke. The in-memory copy is
+    as fast as a ``:memory:`` database, but needn't be rebuilt by every
+    process. :meth:`update` and :meth:`remove` change both the copy
+    and the file.
+
+    Besides its own table, a database can hold any number of named
+    collections (see :meth:`add_collection`), which share its file and
+    connection and can be searched together with
+    :meth:`search_collections`.
+
+    ``tokenizer`` is the FTS ``tokenize`` argument: ``'simple'`` (the
+    default), ``'porter'``, :const:`FOLDING_TOKENIZER` (see
+    :func:`unicode61_tokenizer`) or any custom tokenizer registered with
+    SQLite, with its arguments.
+
+    With ``concurrent=True``, the database can be searched from several
+    threads while it's being changed: ``file`` is put in WAL mode, each
+    thread reads through a connection of its own (:attr:`con` is
+    thread-local), and :meth:`update` and :meth:`remove` queue their
+    changes for a :class:`Writer` thread, which commits them in the
+    background. ``file`` is never loaded into memory, as readers
+    wouldn't see the changes. Build the database with :meth:`create`
+    before starting the other threads. A :class:`SearchPool` runs
+    searches in a bounded number of threads, and works with asyncio.
+
+    :param data: items to index
+    :type data: ``list`` or ``tuple``
+    :param file: path of database file
+    :type file: ``unicode``
+    :param memory: whether to load ``file`` into memory
+    :type memory: ``Boolean`` or ``'auto'``
+    :param tokenizer: tokenizer spec
+    :type tokenizer: ``unicode``
+    :param concurrent: allow searches from several threads and
+        changes in the background
+    :type concurrent: ``Boolean``
+
+    """
+
+    #: Number of rows :meth:`create` inserts (and commits) at a time
+    BATCH_SIZE = 10000
+    #: SQLite module tables are created with
+    MODULE = 'fts3'
+
+    def __init__(self, data, file=None, memory=False, tokenizer=None,
+                 concurrent=False):
         self.data = data
         self._file = file or ':memory:'
+        self._memory = memory
         self._table = 'filter'
         self._fields = 'id, data'
-        self._tokenizer = 'simple'
-        self.con = sqlite3.connect(self._file)
+        self._tokenizer = tokenizer or 'simple'
+        if concurrent and self._file == ':memory:':
+            raise ValueError('A concurrent database needs a file')
+        self.concurrent = concurrent
+        #: :class:`Collection` instances, keyed by name
+        self.collections = OrderedDict()
+        # Connection and ranking functions, per thread if concurrent
+        self._state = _ThreadState() if concurrent else _State()
+        # Every connection opened, so `close` can close them
+        self._connections = []
+        self._lock = threading.Lock()
+        self._writer = None
+        # Connection `_write` saves changes to the file with, if `con`
+        # is an in-memory copy of it
+        self._file_con = None
+        self._loaded = False
+        if self._is_built():
+            self._open()
+        else:
+            # Built by `create`, then opened with `_open`
+            self._connect(sqlite3.connect(self._file))
+        # Whether `create` has run
+        self._created = False
+        # Formatted SQL statements, keyed by everything they depend on,
+        # so the same string is passed to SQLite's statement cache
+        self._sql = {}
 
     # Properties  -------------------------------------------------------------
 
+    @property
+    def con(self):
+        """Connection to the database. The calling thread's own
+        connection if the database is concurrent"""
+        if self._state.con is None and self.concurrent:
+            self._connect(self._read_connection())
+        return self._state.con
+
+    @con.setter
+    def con(self, value):
+        self._state.con = value
+
+    @property
+    def _rank_functions(self):
+        return self._state.rank_functions
+
+    @_rank_functions.setter
+    def _rank_functions(self, value):
+        self._state.rank_functions = value
+
     @property
     def file(self):
         return self._file
@@ -52,79 +220,619 @@ class FTSDatabase(object):
 
     # API  --------------------------------------------------------------------
 
-    def create(self, table=None, fields=None, tokenizer=None):
+    def create(self, table=None, fields=None, tokenizer=None,
+               batch_size=None):
+        """Create and fill the table if the database is new.
+
+        Rows are inserted with ``executemany`` in batches of
+        ``batch_size`` (default :attr:`BATCH_SIZE`), each in its own
+        transaction, with the :const:`BUILD_PRAGMAS` set for the
+        duration. The full-text index is optimised afterwards.
+
+        """
         # Allow for dynamic table and field names
         self.table = table or self._table
         self.fields = fields or self._fields
         self.tokenizer = tokenizer or self._tokenizer
 
-        with self.con:
-            cur = self.con.cursor()
-            # Create virtual table if new database
-            if not path.exists(self.file) or path.getsize(self.file) == 0:
-                print('creating...')
-                sql = ('CREATE VIRTUAL TABLE {table} '
-                       'USING fts3({columns}, tokenize={tokenizer})')
-                sql = sql.format(table=self.table,
-                                 columns=self.fields,
-                                 tokenizer=self.tokenizer)
-                self._execute(cur, sql)
-                # Fill and index virtual table
-                sql = None
-                for i, item in enumerate(self.data):
-                    values = self._prepare_values(i, item)
-                    if not sql:
-                        sql = ('INSERT OR IGNORE INTO {table} '
-                               '({columns}) VALUES ({data})')
-                        sql = sql.format(table=self.table,
-                                         columns=self.fields,
-                                         data=', '.join('?' * len(values)))
-                    cur.execute(sql, values)
+        if self._created:
+            return
+        self._created = True
+        rows = (self._prepare_values(i, item)
+                for i, item in enumerate(self.data))
+        self._build(self.table, self.fields, self.tokenizer, rows,
+                    batch_size)
 
     def search(self, query, ranks=None):
         # If user runs `search` first, bootstrap database
         # with default `table`, `fields`, and `tokenizer`.
-        self.create()
-        # nested SELECT to keep from calling the rank function
-        # multiple times per row.
-        sql = ('SELECT * FROM '
-               '(SELECT rank(matchinfo({table})) '
-               'AS score, {columns} '
-               'FROM {table} '
-               'WHERE {table} MATCH ?) '
-               'ORDER BY score DESC;').format(table=self.table,
-                                              columns=self.fields)
+        if not self._created:
+            self.create()
+        return self._search(self.table, self.fields, query, ranks)
+
+    def search_rules(self, rules, ranks=None, limit=0, min_score=0,
+                     ascending=False):
+        """Run several ``MATCH`` queries in a single statement.
+
+        The queries are combined with ``UNION ALL`` and grouped by
+        ``docid``, so each document is returned once, with its highest
+        score and the tag of the query that produced it. On a tie, the
+        query that comes first in ``rules`` wins.
+
+        :param rules: list of ``(tag, query)`` tuples
+        :type rules: ``list``
+        :param ranks: relative ranking per column
+        :type ranks: ``list`` or ``tuple``
+        :param limit: If non-zero, return at most this many rows.
+        :type limit: ``int``
+        :param min_score: Only return rows that score higher than this.
+        :type min_score: ``float``
+        :param ascending: set to ``True`` to get worst matches first
+        :type ascending: ``Boolean``
+        :returns: rows of ``score, <fields>, rule``
+        :rtype: ``list`` of :class:`sqlite3.Row`
+
+        """
+        if not self._created:
+            self.create()
+        return self._search_rules(self.table, self.fields, rules, ranks,
+                                  limit, min_score, ascending)
+
+    def search_words(self, words, ranks=None, limit=0, min_score=0,
+                     ascending=False):
+        """Return the documents that match every word, each word with
+        its own rules, in a single statement.
+
+        A document's score is the sum of its words' scores, each as
+        :meth:`search_rules` would give it, and its tag that of the
+        last word. Only documents that match every word are ranked.
+
+        :param words: one list of ``(tag, query)`` tuples per word
+        :type words: ``list``
+        :param ranks: relative ranking per column
+        :type ranks: ``list`` or ``tuple``
+        :param limit: If non-zero, return at most this many rows.
+        :type limit: ``int``
+        :param min_score: Only return rows that score higher than this.
+        :type min_score: ``float``
+        :param ascending: set to ``True`` to get worst matches first
+        :type ascending: ``Boolean``
+        :returns: rows of ``score, <fields>, rule``
+        :rtype: ``list`` of :class:`sqlite3.Row`
+
+        """
+        if not self._created:
+            self.create()
+        return self._search_words(self.table, self.fields, words, ranks,
+                                  limit, min_score, ascending)
+
+    def search_many(self, queries, limit=0, ranks=None, pool=None):
+        """Run many queries, e.g. to evaluate ranking on a query log.
+
+        Every query runs through the same statement and cursor, with
+        the ranking function registered once. A query that SQLite
+        rejects (e.g. a malformed ``MATCH``) gets no rows and its
+        error, instead of stopping the rest.
+
+        With a :class:`SearchPool`, the queries are split into one
+        run per worker.
+
+        :param queries: ``MATCH`` queries
+        :type queries: iterable
+        :param limit: If non-zero, return at most this many rows per
+            query.
+        :type limit: ``int``
+        :param ranks: relative ranking per column
+        :type ranks: ``list`` or ``tuple``
+        :param pool: pool of this database to run the queries in
+        :type pool: :class:`SearchPool`
+        :returns: results in the order of ``queries``
+        :rtype: ``list`` of :class:`QueryResult`
+
+        """
+        if not self._created:
+            self.create()
+        queries = list(queries)
+        if pool is not None:
+            if pool.db is not self:
+                raise ValueError('SearchPool is for another database')
+            size = -(-len(queries) // pool.workers)
+            tasks = [pool.submit(self.search_many,
+                                 queries[i:i + size], limit, ranks)
+                     for i in range(0, len(queries), size or 1)]
+            results = []
+            for task in tasks:
+                results.extend(task.result())
+            return results
+
+        rank = self._rank_function(ranks)
+        key = ('search_many', self.table, self.fields, rank)
+        sql = self._sql.get(key)
+        if sql is None:
+            sql = self._sql[key] = (
+                'SELECT * FROM '
+                '(SELECT {rank}(matchinfo({table})) '
+                'AS score, {columns} '
+                'FROM {table} '
+                'WHERE {table} MATCH ?) '
+                'ORDER BY score DESC '
+                'LIMIT ?;').format(rank=rank, table=self.table,
+                                   columns=self.fields)
+        cur = self.con.cursor()
+        results = []
+        for query in queries:
+            start = time.time()
+            rows, error = [], None
+            try:
+                rows = cur.execute(sql, (query, limit or -1)).fetchall()
+            except sqlite3.OperationalError as err:
+                error = str(err)
+            results.append(QueryResult(query, rows, time.time() - start,
+                                       error))
+        return results
+
+    def add_collection(self, name, data, fields='id, data', tokenizer=None,
+                       ranks=None, prepare=None):
+        """Add a named collection of ``data`` to this database.
+
+        Each collection is a table of its own in :attr:`file`, with its
+        own fields, tokenizer and ranking, but all collections share
+        :attr:`con`. The table is built the first time the collection
+        is searched, unless the file already has it.
+
+        ``name`` mustn't be taken by another table, including the
+        tables SQLite keeps each full-text table's data in, which are
+        named after it (e.g. ``filter_content``).
+
+        :param name: collection (and table) name
+        :type name: ``unicode``
+        :param data: items to index
+        :type data: ``list`` or ``tuple``
+        :param fields: comma-separated column names
+        :type fields: ``unicode``
+        :param tokenizer: tokenizer spec (default :attr:`tokenizer`)
+        :type tokenizer: ``unicode``
+        :param ranks: default relative ranking per column
+        :type ranks: ``list`` or ``tuple``
+        :param prepare: function that returns the column values of an
+            item from its index and the item (default
+            :func:`prepare_values`)
+        :type prepare: ``callable``
+        :returns: the new collection
+        :rtype: :class:`Collection`
+
+        """
+        if name in self.collections:
+            raise ValueError('Collection already exists: {!r}'.format(name))
+        if not self._is_free(name):
+            raise ValueError('Invalid collection name: {!r}'.format(name))
+        collection = Collection(self, name, data, fields,
+                                tokenizer or self.tokenizer, ranks, prepare)
+        self.collections[name] = collection
+        return collection
+
+    def search_collections(self, query, names=None, limit=0):
+        """Search several collections with one statement.
+
+        Each collection's rows are scored with its own ``ranks``, so
+        weight collections against each other with those.
+
+        :param query: ``MATCH`` query
+        :type query: ``unicode``
+        :param names: collections to search (default all)
+        :type names: ``list``
+        :param limit: If non-zero, return at most this many rows.
+        :type limit: ``int``
+        :returns: rows of ``score, collection, docid``, best first. Get
+            the full row with :meth:`Collection.get`
+        :rtype: ``list`` of :class:`sqlite3.Row`
+
+        """
+        collections = [self.collections[name]
+                       for name in (names or self.collections)]
+        if not collections:
+            return []
+        for collection in collections:
+            collection.create()
+        ranks = [self._rank_function(c.ranks, c.fields) for c in collections]
+        key = ('search_collections', tuple([c.name for c in collections]),
+               tuple(ranks))
+        sql = self._sql.get(key)
+        if sql is None:
+            selects = ['SELECT {rank}(matchinfo({table})) AS score, '
+                       '? AS collection, docid '
+                       'FROM {table} '
+                       'WHERE {table} MATCH ?'.format(rank=rank,
+                                                      table=c.name)
+                       for c, rank in zip(collections, ranks)]
+            sql = self._sql[key] = (
+                'SELECT * FROM ({union}) '
+                'ORDER BY score DESC '
+                'LIMIT ?;').format(union=' UNION ALL '.join(selects))
+        params = []
+        for collection in collections:
+            params.extend((collection.name, query))
+        params.append(limit or -1)
+        return self.con.execute(sql, params).fetchall()
+
+    def update(self, i, item):
+        """Index ``item`` as item ``i``, replacing the row of any
+        previous item ``i``.
+
+        If the database is concurrent, the change is made in the
+        background: call :meth:`flush` to wait for it.
+
+        """
+        if not self._created:
+            self.create()
+        values = self._prepare_values(i, item)
+        key = ('update', self.table, self.fields)
+        sql = self._sql.get(key)
+        if sql is None:
+            sql = self._sql[key] = (
+                'INSERT OR REPLACE INTO {table} (docid, {columns}) '
+                'VALUES (?, {data})').format(table=self.table,
+                                             columns=self.fields,
+                                             data=', '.join('?' * len(values)))
+        # Rows are numbered from 1 in the order of `data`
+        self._write(sql, [i + 1] + list(values))
+
+    def remove(self, i):
+        """Remove the row of item ``i``. See :meth:`update`"""
+        if not self._created:
+            self.create()
+        self._write('DELETE FROM {table} WHERE docid = ?'.format(
+            table=self.table), (i + 1,))
+
+    def flush(self):
+        """Wait until the :class:`Writer` has committed every change
+        made so far.
+
+        :raises WriteError: if any of the changes failed
+
+        """
+        if self._writer is not None:
+            self._writer.flush()
+
+    def close(self):
+        """Commit outstanding changes and close all connections"""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for con in connections:
+            con.close()
+        self.con = None
+        self._file_con = None
+
+    ## Helper Methods  --------------------------------------------------------
+
+    def _write(self, sql, params):
+        """Execute change ``sql``, in the :class:`Writer` thread if the
+        database is concurrent"""
+        if not self.concurrent:
+            if self._loaded:
+                # `con` is a copy, so change the file first
+                if self._file_con is None:
+                    self._file_con = sqlite3.connect(self.file)
+                    with self._lock:
+                        self._connections.append(self._file_con)
+                with self._file_con:
+                    self._file_con.execute(sql, params)
+            with self.con:
+                self.con.execute(sql, params)
+            return
+        with self._lock:
+            if self._writer is None:
+                self._writer = Writer(self.file)
+                self._writer.start()
+        self._writer.execute(sql, params)
+
+    def _read_connection(self):
+        """Return a new connection to the database file in WAL mode.
+        It may be closed by any thread (see :meth:`close`)"""
+        con = sqlite3.connect(self.file, check_same_thread=False)
+        # Readers don't block the writer or each other. The mode is
+        # saved in the file, so this is a no-op after the first time
+        con.execute('PRAGMA journal_mode = WAL')
+        con.execute('PRAGMA mmap_size = {}'.format(MMAP_SIZE))
+        return con
+
+    def _build(self, table, fields, tokenizer, rows, batch_size=None):
+        """Create ``table`` and fill it with ``rows`` if :attr:`file`
+        doesn't have it yet, or only has part of it"""
+        if self._is_complete(table):
+            return
+        if self._loaded:
+            # Build in the file, not in the in-memory copy of it
+            self._disconnect()
+            self._connect(sqlite3.connect(self.file))
+        pragmas = self._set_pragmas(BUILD_PRAGMAS)
+        try:
+            with self.con:
+                cur = self.con.cursor()
+                cur.execute('CREATE TABLE IF NOT EXISTS {} '
+                            '(name TEXT PRIMARY KEY)'.format(BUILT_TABLE))
+                # Left by a build that didn't finish
+                cur.execute('DROP TABLE IF EXISTS {}'.format(table))
+                sql = ('CREATE VIRTUAL TABLE {table} '
+                       'USING {module}({columns}, tokenize={tokenizer})')
+                sql = sql.format(table=table,
+                                 module=self.MODULE,
+                                 columns=fields,
+                                 tokenizer=tokenizer)
+                self._execute(cur, sql, table)
+            # Fill and index virtual table
+            self._insert(table, fields, rows, batch_size or self.BATCH_SIZE)
+            with self.con:
+                # Merge the index b-trees the batches created
+                self.con.execute('INSERT INTO {table}({table}) '
+                                 "VALUES('optimize')".format(table=table))
+                self.con.execute('INSERT INTO {} VALUES (?)'.format(
+                    BUILT_TABLE), (table,))
+        finally:
+            self._set_pragmas(pragmas)
+        if self.file != ':memory:':
+            self._open()
+
+    def _search(self, table, fields, query, ranks=None):
+        """Return rows of ``table`` that match ``query``, best first"""
+        rank = self._rank_function(ranks, fields)
+        key = ('search', table, fields, rank)
+        sql = self._sql.get(key)
+        if sql is None:
+            # nested SELECT to keep from calling the rank function
+            # multiple times per row.
+            sql = self._sql[key] = (
+                'SELECT * FROM '
+                '(SELECT {rank}(matchinfo({table})) '
+                'AS score, {columns} '
+                'FROM {table} '
+                'WHERE {table} MATCH ?) '
+                'ORDER BY score DESC;').format(rank=rank, table=table,
+                                               columns=fields)
+        return self.con.execute(sql, (query,)).fetchall()
+
+    def _search_rules(self, table, fields, rules, ranks=None, limit=0,
+                      min_score=0, ascending=False):
+        """Implementation of :meth:`search_rules` for any ``table``"""
+        rank = self._rank_function(ranks, fields)
+        order = 'ASC' if ascending else 'DESC'
+        key = ('search_rules', table, fields, rank, len(rules), order)
+        sql = self._sql.get(key)
+        if sql is None:
+            select = ('SELECT {rank}(matchinfo({table})) AS s, docid, '
+                      '{columns}, ? AS rule '
+                      'FROM {table} '
+                      'WHERE {table} MATCH ?').format(rank=rank,
+                                                      table=table,
+                                                      columns=fields)
+            sql = self._sql[key] = (
+                'SELECT max(s) AS score, {columns}, rule FROM '
+                '({union}) '
+                'GROUP BY docid HAVING max(s) > ? '
+                'ORDER BY score {order}, docid {order} '
+                'LIMIT ?;').format(columns=fields,
+                                   union=' UNION ALL '.join(
+                                       [select] * len(rules)),
+                                   order=order)
+        params = []
+        for tag, query in rules:
+            params.extend((tag, query))
+        # SQLite treats a negative limit as no limit
+        params.extend((min_score, limit or -1))
+        return self.con.execute(sql, params).fetchall()
+
+    def _search_words(self, table, fields, words, ranks=None, limit=0,
+                      min_score=0, ascending=False):
+        """Implementation of :meth:`search_words` for any ``table``"""
+        if len(words) == 1:
+            return self._search_rules(table, fields, words[0], ranks,
+                                      limit, min_score, ascending)
+        rank = self._rank_function(ranks, fields)
+        order = 'ASC' if ascending else 'DESC'
+        key = ('search_words', table, fields, rank,
+               tuple(len(rules) for rules in words), order)
+        sql = self._sql.get(key)
+        if sql is None:
+            # Documents that match every word by any of its rules,
+            # straight from the full-text index. Only these get ranked.
+            match = 'SELECT docid FROM {table} WHERE {table} MATCH ?'.format(
+                table=table)
+            candidates = ' INTERSECT '.join(
+                'SELECT docid FROM ({})'.format(
+                    ' UNION '.join([match] * len(rules)))
+                for rules in words)
+            select = ('SELECT {rank}(matchinfo({table})) AS s, docid, '
+                      '? AS rule '
+                      'FROM {table} '
+                      'WHERE {table} MATCH ? '
+                      'AND docid IN candidates').format(rank=rank,
+                                                        table=table)
+            # Best score (and its tag) of each document for one word
+            word = 'SELECT docid, max(s) AS s, rule FROM ({}) GROUP BY docid'
+            subqueries = ['({}) AS w{}'.format(
+                word.format(' UNION ALL '.join([select] * len(rules))), i)
+                for i, rules in enumerate(words)]
+            joins = ' '.join('JOIN {} USING (docid)'.format(subquery)
+                             for subquery in subqueries[1:])
+            columns = ', '.join('{}.{}'.format(table, column.strip())
+                                for column in fields.split(','))
+            sql = self._sql[key] = (
+                'WITH candidates AS ({candidates}) '
+                'SELECT {total} AS score, {columns}, w{last}.rule AS rule '
+                'FROM {first} {joins} '
+                'JOIN {table} ON {table}.docid = w0.docid '
+                'WHERE score > ? '
+                'ORDER BY score {order}, w0.docid {order} '
+                'LIMIT ?;').format(
+                    candidates=candidates,
+                    total=' + '.join('w{}.s'.format(i)
+                                     for i in range(len(words))),
+                    columns=columns, last=len(words) - 1,
+                    first=subqueries[0], joins=joins, table=table,
+                    order=order)
+        params = []
+        for rules in words:
+            params.extend(query for _, query in rules)
+        for rules in words:
+            for tag, query in rules:
+                params.extend((tag, query))
+        # SQLite treats a negative limit as no limit
+        params.extend((min_score, limit or -1))
+        return self.con.execute(sql, params).fetchall()
+
+    def _is_built(self):
+        """Whether :attr:`file` is a database that's already been built"""
+        return path.exists(self.file) and path.getsize(self.file) > 0
+
+    def _is_complete(self, table):
+        """Whether ``table`` has been built and filled completely"""
+        if not self._has_table(BUILT_TABLE):
+            return False
+        row = self.con.execute('SELECT 1 FROM {} WHERE name = ?'.format(
+            BUILT_TABLE), (table,)).fetchone()
+        return row is not None
+
+    def _is_free(self, name):
+        """Whether ``name`` can be used for a new collection's table"""
+        if not COLLECTION_NAME.match(name):
+            return False
+        # SQLite's table names are case-insensitive
+        name = name.lower()
+        if name.startswith('sqlite_'):
+            return False
+        # Full-text tables, which own the tables named ``<table>_*``
+        tables = set([self.table.lower()])
+        tables.update(other.lower() for other in self.collections)
+        if name in tables:
+            return False
+        # The file may already have this collection's table
+        for table, sql in self.con.execute(
+                "SELECT name, sql FROM sqlite_master WHERE type = 'table'"):
+            if sql.upper().startswith('CREATE VIRTUAL TABLE'):
+                tables.add(table.lower())
+            elif table.lower() == name:
+                return False
+        return not any(name.startswith(table + '_') or
+                       table.startswith(name + '_') for table in tables)
+
+    def _has_table(self, table):
+        """Whether the database has a table called ``table``"""
+        row = self.con.execute('SELECT 1 FROM sqlite_master '
+                               "WHERE type = 'table' AND name = ?",
+                               (table,)).fetchone()
+        return row is not None
+
+    def _open(self):
+        """Open the built database :attr:`file` in the way ``memory``
+        says"""
+        memory = self._memory
+        if memory == 'auto':
+            memory = path.getsize(self.file) <= MEMORY_MAX_SIZE
+        self._disconnect()
+        if self.concurrent:
+            self._connect(self._read_connection())
+            memory = False
+        elif memory:
+            self._connect(load_into_memory(self.file))
+        else:
+            self._connect(sqlite3.connect(self.file))
+            self.con.execute('PRAGMA mmap_size = {}'.format(MMAP_SIZE))
+        # Whether `con` is an in-memory copy of `file`
+        self._loaded = bool(memory)
+
+    def _connect(self, con):
+        """Use connection ``con``"""
+        with self._lock:
+            self._connections.append(con)
+        self.con = con
         # `sqlite3.Row` provides both index-based and
         # case-insensitive name-based access to columns
         # with almost no memory overhead
         self.con.row_factory = sqlite3.Row
-        with self.con:
-            cur = self.con.cursor()
-            ranks = ranks or [1.0] * len(self.fields)
-            self.con.create_function('rank', 1, self.make_rank_func(ranks))
-            cur.execute(sql, (query,))
-            return cur.fetchall()
+        # Names of the ranking functions registered with `con`, keyed
+        # by their weights
+        self._rank_functions = {}
+        self._loaded = False
 
-    ## Helper Methods  --------------------------------------------------------
+    def _disconnect(self):
+        """Close the connection :attr:`con` is using, if any"""
+        con = self._state.con
+        if con is not None:
+            con.close()
+            with self._lock:
+                self._connections.remove(con)
+            self.con = None
+
+    def _rank_function(self, ranks=None, fields=None):
+        """Return name of the SQL ranking function for ``ranks``,
+        registering it with :attr:`con` the first time.
+
+        :param ranks: relative ranking per column (default 1.0 each)
+        :type ranks: ``list`` or ``tuple``
+        :param fields: columns ranked (default :attr:`fields`)
+        :type fields: ``unicode``
+        :rtype: ``unicode``
+
+        """
+        fields = fields or self.fields
+        ranks = tuple(ranks or [1.0] * len(fields.split(',')))
+        # Opens the thread's connection first, if need be
+        con = self.con
+        name = self._rank_functions.get(ranks)
+        if name is None:
+            name = 'rank{}'.format(len(self._rank_functions))
+            con.create_function(name, 1, self.make_rank_func(ranks))
+            self._rank_functions[ranks] = name
+        return name
+
+    def _insert(self, table, fields, rows, batch_size):
+        """Insert ``rows`` into ``table``, ``batch_size`` rows at a time"""
+        rows = iter(rows)
+        sql = None
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            if not sql:
+                sql = ('INSERT OR IGNORE INTO {table} '
+                       '({columns}) VALUES ({data})')
+                sql = sql.format(table=table,
+                                 columns=fields,
+                                 data=', '.join('?' * len(batch[0])))
+            with self.con:
+                self.con.executemany(sql, batch)
+
+    def _set_pragmas(self, pragmas):
+        """Set PRAGMAs from ``(name, value)`` tuples
+
+        :returns: the previous values, in the same format
+
+        """
+        previous = []
+        for name, value in pragmas:
+            old = self.con.execute('PRAGMA {}'.format(name)).fetchone()[0]
+            previous.append((name, old))
+            self.con.execute('PRAGMA {} = {}'.format(name, value))
+        return previous
 
-    def _execute(self, cur, sql):
+    def _execute(self, cur, sql, table=None):
         try:
             cur.execute(sql)
         except sqlite3.OperationalError as err:
-            exists_error = b'table {} already exists'.format(self.table)
-            if err.message == exists_error:
+            message = str(err)
+            if message == 'table {} already exists'.format(table or
+                                                           self.table):
                 pass
-            elif b'malformed MATCH' in err.message:
+            elif 'malformed MATCH' in message:
                 return 'Invalid query'
             else:
                 raise err
 
     def _prepare_values(self, i, item):
-        values = [i, item]
-        if hasattr(item, '__iter__'):
-            values = [self._quote(self._unquote(x))
-                      for x in item]
-        return values
+        return prepare_values(i, item)
 
     @staticmethod
     def _quote(text):
@@ -158,8 +866,477 @@ class FTSDatabase(object):
             bufsize = len(matchinfo)  # Length in bytes.
             matchinfo = [struct.unpack(b'I', matchinfo[i:i + 4])[0]
                          for i in range(0, bufsize, 4)]
+            # One triple per column per phrase, so the weights
+            # repeat for each phrase in the query
+            columns = matchinfo[1]
             it = iter(matchinfo[2:])
-            return sum(x[0] * w / x[1]
-                       for x, w in zip(zip(it, it, it), weights)
+            return sum(x[0] * weights[i % columns] / x[1]
+                       for i, x in enumerate(zip(it, it, it))
                        if x[1])
         return rank
+
+
+class _State(object):
+    """Connection of an `FTSDatabase` and the names of the ranking
+    functions registered with it"""
+    con = None
+    rank_functions = None
+
+
+class _ThreadState(threading.local, _State):
+    """`_State` of each thread"""
+
+
+class WriteError(sqlite3.Error):
+    """Raised by :meth:`Writer.flush` if changes failed.
+
+    :attr:`errors` is a list of ``(sql, params, error)`` tuples, one
+    per change that failed.
+
+    """
+
+    def __init__(self, errors):
+        super(WriteError, self).__init__(
+            '{} change(s) failed, the first with: {}'.format(
+                len(errors), errors[0][2]))
+        self.errors = errors
+
+
+class Writer(threading.Thread):
+    """Thread that makes all changes to a concurrent `FTSDatabase`.
+
+    Changes are queued with :meth:`execute`. Whenever the thread wakes
+    up, it commits everything queued so far in one transaction, so
+    searches in other threads only ever wait for SQLite to write, not
+    for the callers that queued the changes. If that transaction fails,
+    the changes are retried one by one, so only the ones that fail are
+    lost.
+
+    :param file: path of database file
+    :type file: ``unicode``
+
+    """
+
+    def __init__(self, file):
+        super(Writer, self).__init__(name='FTSDatabase writer')
+        self.daemon = True
+        self.file = file
+        self.queue = Queue()
+        # ``(sql, params, error)`` of changes that failed, until
+        # `flush` raises them
+        self.errors = []
+
+    def run(self):
+        con = sqlite3.connect(self.file)
+        stop = False
+        while not stop:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            # `None` is the signal from `close`
+            stop = None in batch
+            tasks = [task for task in batch if task is not None]
+            try:
+                with con:
+                    for task in tasks:
+                        con.execute(*task)
+            except sqlite3.Error:
+                for sql, params in tasks:
+                    try:
+                        with con:
+                            con.execute(sql, params)
+                    except sqlite3.Error as err:
+                        self.errors.append((sql, params, err))
+            for _ in batch:
+                self.queue.task_done()
+        con.close()
+
+    def execute(self, sql, params=()):
+        """Queue change ``sql`` with ``params``"""
+        self.queue.put((sql, params))
+
+    def flush(self):
+        """Wait until every change queued so far has been committed.
+
+        :raises WriteError: if any of them failed
+
+        """
+        self.queue.join()
+        self._raise_errors()
+
+    def close(self):
+        """Commit outstanding changes and stop the thread"""
+        self.queue.put(None)
+        self.join()
+        self._raise_errors()
+
+    def _raise_errors(self):
+        errors, self.errors = self.errors, []
+        if errors:
+            raise WriteError(errors)
+
+
+class CancelledError(Exception):
+    """Raised by :meth:`SearchTask.result` if the task was cancelled"""
+
+
+class SearchTask(object):
+    """A search running in a :class:`SearchPool`.
+
+    Like a :class:`concurrent.futures.Future`: :meth:`result` waits
+    for and returns the search's rows. Unlike one, :meth:`cancel` also
+    stops a search that's already running, by interrupting the SQLite
+    statement.
+
+    Under asyncio, ``await task`` returns the rows and ``async for row
+    in task`` iterates over them. Cancelling the awaiting coroutine
+    cancels the search.
+
+    """
+
+    def __init__(self, func, args):
+        self._func = func
+        self._args = args
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._callbacks = []
+        # Connection running the search, which `cancel` interrupts
+        self._con = None
+        self._cancelled = False
+        self._result = None
+        self._error = None
+
+    def run(self, db):
+        """Run the search on the calling thread's connection to ``db``"""
+        with self._lock:
+            if self._cancelled:
+                return
+            self._con = db.con
+        result = error = None
+        try:
+            result = self._func(*self._args)
+        except Exception as err:
+            error = err
+        with self._lock:
+            self._con = None
+            if self._cancelled:
+                # Most likely `interrupted`, which is no error
+                error = CancelledError()
+        self._finish(result, error)
+
+    def cancel(self):
+        """Cancel the search, interrupting it if it's running.
+
+        :returns: ``False`` if the search has already finished
+        :rtype: ``Boolean``
+
+        """
+        with self._lock:
+            if self._done.is_set():
+                return False
+            self._cancelled = True
+            if self._con is not None:
+                # `run` finishes the task when the statement stops
+                self._con.interrupt()
+                return True
+        self._finish(None, CancelledError())
+        return True
+
+    def cancelled(self):
+        return self._cancelled
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Return the rows of the search, waiting up to ``timeout``
+        seconds for it to finish.
+
+        :raises CancelledError: if the search was cancelled
+        :raises RuntimeError: if it didn't finish in ``timeout``
+
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError('Search is still running')
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def add_done_callback(self, func):
+        """Call ``func(task)`` when the task is done, from the thread
+        that finishes it (or now, if it's done already)"""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _finish(self, result, error):
+        with self._lock:
+            if self._done.is_set():
+                return
+            self._result, self._error = result, error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            func(self)
+
+    def _asyncio_future(self, set_result):
+        """Return asyncio future of the running loop that
+        ``set_result(future)`` completes when the task is done"""
+        import asyncio
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def done(_):
+            if future.cancelled():
+                return
+            if self._cancelled:
+                future.cancel()
+                return
+            try:
+                set_result(future)
+            except Exception as err:
+                future.set_exception(err)
+
+        def cancelled(future):
+            if future.cancelled():
+                self.cancel()
+
+        def wake(_):
+            # Nobody is waiting any more if the loop has moved on
+            if not future.done() and not loop.is_closed():
+                loop.call_soon_threadsafe(done, self)
+
+        future.add_done_callback(cancelled)
+        if self.done():
+            done(self)
+        else:
+            self.add_done_callback(wake)
+        return future
+
+    def __await__(self):
+        def set_result(future):
+            future.set_result(self.result())
+        return self._asyncio_future(set_result).__await__()
+
+    def __aiter__(self):
+        return _AsyncRows(self)
+
+
+class _AsyncRows(object):
+    """Asynchronous iterator over the rows of a `SearchTask`"""
+
+    def __init__(self, task):
+        self.task = task
+        self.rows = None
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        def set_result(future):
+            if self.rows is None:
+                self.rows = iter(self.task.result())
+            try:
+                future.set_result(next(self.rows))
+            except StopIteration:
+                future.set_exception(StopAsyncIteration())  # noqa: F821
+        return self.task._asyncio_future(set_result)
+
+
+class SearchPool(object):
+    """Run searches of a concurrent `FTSDatabase` in worker threads.
+
+    At most ``workers`` searches run at once, each on its thread's own
+    connection to the database. Searches wait in a queue for a free
+    worker. The methods return :class:`SearchTask` instances, which
+    can be awaited under asyncio instead of calling
+    ``loop.run_in_executor``.
+
+    :param db: database with ``concurrent=True``
+    :type db: :class:`FTSDatabase`
+    :param workers: number of worker threads
+    :type workers: ``int``
+
+    """
+
+    def __init__(self, db, workers=4):
+        if not db.concurrent:
+            raise ValueError('SearchPool needs a concurrent database')
+        self.db = db
+        self.workers = workers
+        self.queue = Queue()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work,
+                                      name='SearchPool worker {}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, *args):
+        """Call ``func(*args)`` in a worker thread, where ``db.con`` is
+        that thread's connection
+
+        :rtype: :class:`SearchTask`
+
+        """
+        task = SearchTask(func, args)
+        self.queue.put(task)
+        return task
+
+    def search(self, query, ranks=None):
+        """:meth:`FTSDatabase.search` in a worker thread"""
+        return self.submit(self.db.search, query, ranks)
+
+    def search_rules(self, rules, ranks=None, limit=0, min_score=0,
+                     ascending=False):
+        """:meth:`FTSDatabase.search_rules` in a worker thread"""
+        return self.submit(self.db.search_rules, rules, ranks, limit,
+                           min_score, ascending)
+
+    def search_words(self, words, ranks=None, limit=0, min_score=0,
+                     ascending=False):
+        """:meth:`FTSDatabase.search_words` in a worker thread"""
+        return self.submit(self.db.search_words, words, ranks, limit,
+                           min_score, ascending)
+
+    def close(self):
+        """Finish the queued searches and stop the workers"""
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            task.run(self.db)
+
+
+class Collection(object):
+    """Named full-text table in a shared :class:`FTSDatabase`.
+
+    Create with :meth:`FTSDatabase.add_collection`. A collection has
+    its own fields, tokenizer and default ``ranks``, but is stored in
+    its database's file and searched with its connection.
+
+    """
+
+    def __init__(self, db, name, data, fields='id, data', tokenizer=None,
+                 ranks=None, prepare=None):
+        self.db = db
+        self.name = name
+        self.data = data
+        self.fields = fields
+        self.tokenizer = tokenizer or 'simple'
+        self.ranks = ranks
+        self.prepare = prepare or prepare_values
+        self._created = False
+
+    def create(self, batch_size=None):
+        """Create and fill the collection's table if the database
+        doesn't have it yet"""
+        if self._created:
+            return
+        self._created = True
+        rows = (self.prepare(i, item) for i, item in enumerate(self.data))
+        self.db._build(self.name, self.fields, self.tokenizer, rows,
+                       batch_size)
+
+    def search(self, query, ranks=None):
+        """Return rows of ``score, <fields>`` that match ``query``,
+        best first"""
+        self.create()
+        return self.db._search(self.name, self.fields, query,
+                               ranks or self.ranks)
+
+    def search_rules(self, rules, ranks=None, limit=0, min_score=0,
+                     ascending=False):
+        """Like :meth:`FTSDatabase.search_rules`"""
+        self.create()
+        return self.db._search_rules(self.name, self.fields, rules,
+                                     ranks or self.ranks, limit, min_score,
+                                     ascending)
+
+    def search_words(self, words, ranks=None, limit=0, min_score=0,
+                     ascending=False):
+        """Like :meth:`FTSDatabase.search_words`"""
+        self.create()
+        return self.db._search_words(self.name, self.fields, words,
+                                     ranks or self.ranks, limit, min_score,
+                                     ascending)
+
+    def get(self, docid):
+        """Return the row with ``docid``, e.g. from
+        :meth:`FTSDatabase.search_collections`"""
+        self.create()
+        return self.db.con.execute(
+            'SELECT {columns} FROM {table} WHERE docid = ?'.format(
+                columns=self.fields, table=self.name), (docid,)).fetchone()
+
+
+def prepare_values(i, item):
+    """Return column values of ``item``, the ``i``-th item of a
+    dataset: ``i`` and ``item``, or the quoted values of ``item`` if
+    it's a sequence"""
+    values = [i, item]
+    # Not any iterable: on Python 3, strings are too
+    if isinstance(item, (list, tuple)):
+        values = [FTSDatabase._quote(FTSDatabase._unquote(x))
+                  for x in item]
+    return values
+
+
+def load_into_memory(file):
+    """Return a connection to an in-memory copy of database ``file``.
+
+    Uses the backup API where :mod:`sqlite3` has it (Python 3.7+).
+    Otherwise, the file is attached and its schema and tables copied:
+    virtual tables are created from their SQL, which creates their
+    shadow tables, then the contents of the ordinary tables (including
+    the shadow tables) are copied, so full-text indices aren't rebuilt.
+
+    :param file: path of database file
+    :type file: ``unicode``
+    :rtype: :class:`sqlite3.Connection`
+
+    """
+    con = sqlite3.connect(':memory:')
+    if hasattr(con, 'backup'):
+        disk = sqlite3.connect(file)
+        disk.backup(con)
+        disk.close()
+        return con
+
+    con.execute('ATTACH DATABASE ? AS snapshot', (file,))
+    schema = con.execute("SELECT type, name, sql FROM snapshot.sqlite_master "
+                         "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+                         "ORDER BY rowid").fetchall()
+    with con:
+        for type_, name, sql in schema:
+            if type_ == 'table' and sql.upper().startswith('CREATE VIRTUAL'):
+                con.execute(sql)
+        virtual = set([name for type_, name, sql in schema
+                       if sql.upper().startswith('CREATE VIRTUAL')])
+        existing = set([row[0] for row in con.execute(
+                        'SELECT name FROM main.sqlite_master')])
+        for type_, name, sql in schema:
+            if type_ != 'table' or name in virtual:
+                continue
+            if name not in existing:
+                con.execute(sql)
+            con.execute('INSERT INTO main."{0}" SELECT * FROM '
+                        'snapshot."{0}"'.format(name))
+        for type_, name, sql in schema:
+            if type_ in ('index', 'trigger', 'view'):
+                con.execute(sql)
+    con.execute('DETACH DATABASE snapshot')
+    return con
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""Fuzzy subsequence scoring for ``MATCH_ALLCHARS``.
+
+A version of fzf's "v2" algorithm: a Smith-Waterman-style alignment of
+the query's characters with a search key that finds the positions with
+the highest score, with bonuses for word starts, camelCase humps and
+runs of consecutive characters, and penalties for gaps between them.
+
+Unlike a ``[^a]*a[^b]*b`` regex, which only finds the leftmost match,
+this finds e.g. the word starts of "Google Chrome" for ``gc``, and
+scores it above "Magic".
+
+It's slower than the regex, though. The alignment only visits the
+positions where each character can match, but it's Python, not ``re``:
+filtering 60,000 four-word items takes about twice as long for ``gc``
+(0.46s vs 0.25s), and more for queries whose characters occur many
+times in most items (1.24s vs 0.54s for ``ac``).
+
+"""
+
+from __future__ import print_function, unicode_literals
+
+# Scores from fzf
+SCORE_MATCH = 16
+SCORE_GAP_START = -3
+SCORE_GAP_EXTENSION = -1
+# Character at the start of a word
+BONUS_BOUNDARY = SCORE_MATCH // 2
+# Capital after a lower-case letter or digit after a non-digit
+BONUS_CAMEL = BONUS_BOUNDARY + SCORE_GAP_EXTENSION
+# Character right after the previous one
+BONUS_CONSECUTIVE = -(SCORE_GAP_START + SCORE_GAP_EXTENSION)
+# The bonus of the query's first character counts this many times
+BONUS_FIRST_CHAR_MULTIPLIER = 2
+
+
+def align(query, lower, value=None):
+    """Return positions of the characters of ``query`` in ``lower``
+    with the highest :func:`raw_score`.
+
+    Only the positions where each character of ``query`` can be
+    matched are scored: those between its first possible match
+    and its last. Each of them is scored once for each way to get
+    there, through a consecutive character or over a gap, so an item
+    without repeated characters takes time linear in its length.
+
+    :param query: lower-case query
+    :type query: ``unicode``
+    :param lower: lower-case search key
+    :type lower: ``unicode``
+    :param value: search key for :func:`bonus`, the same length as
+        ``lower`` (default: ``lower``)
+    :type value: ``unicode``
+    :returns: list of positions or ``None`` if ``query`` isn't a
+        subsequence of ``lower``
+
+    """
+    match = _align(query, lower, value or lower)
+    if match is None:
+        return None
+    return match[1]
+
+
+def _align(query, lower, value):
+    """Return ``(raw_score, positions)`` of :func:`align` or ``None``"""
+    # First possible match of each character
+    first = []
+    p = -1
+    for c in query:
+        p = lower.find(c, p + 1)
+        if p < 0:
+            return None
+        first.append(p)
+    # and last
+    last = [0] * len(query)
+    p = len(lower)
+    for i in range(len(query) - 1, -1, -1):
+        p = last[i] = lower.rfind(query[i], 0, p)
+    if first == last:
+        # Only one way to match
+        return raw_score(value, first), first
+
+    # One row of cells per character of `query`, one cell per position
+    # it matches at: ``(position, score, bonus of run start, index of
+    # cell in previous row)``
+    rows = []
+    prev = None
+    for i, c in enumerate(query):
+        row = []
+        # Best cell of the previous row to reach the next position
+        # from over a gap, and its score without the gap
+        k = 0
+        gap = gap_k = None
+        j = lower.find(c, first[i])
+        while 0 <= j <= last[i]:
+            b = bonus(value, j)
+            if prev is None:
+                row.append((j, SCORE_MATCH + b * BONUS_FIRST_CHAR_MULTIPLIER,
+                            b, None))
+                j = lower.find(c, j + 1)
+                continue
+            while k < len(prev) and prev[k][0] < j - 1:
+                # Gap penalties grow with the position, so the score
+                # over a gap from each cell is relative to its own
+                s = prev[k][1] - SCORE_GAP_EXTENSION * prev[k][0]
+                if gap is None or s > gap:
+                    gap, gap_k = s, k
+                k += 1
+            cell = None
+            if gap is not None:
+                cell = (j, gap + SCORE_GAP_START +
+                        SCORE_GAP_EXTENSION * (j - 2) + SCORE_MATCH + b,
+                        b, gap_k)
+            if k < len(prev) and prev[k][0] == j - 1:
+                # A run keeps the bonus of the character it started at
+                run = prev[k][2]
+                s = prev[k][1] + SCORE_MATCH + max(b, run, BONUS_CONSECUTIVE)
+                if cell is None or s >= cell[1]:
+                    cell = (j, s, run, k)
+            if cell is not None:
+                row.append(cell)
+            j = lower.find(c, j + 1)
+        rows.append(row)
+        prev = row
+
+    # Every character has a cell in its row, as `first` is a match
+    cell = best = max(prev, key=lambda t: t[1])
+    positions = []
+    for row in reversed(rows[:-1]):
+        positions.append(cell[0])
+        cell = row[cell[3]]
+    positions.append(cell[0])
+    positions.reverse()
+    return best[1], positions
+
+
+def bonus(value, p):
+    """Return bonus for matching character ``p`` of ``value``"""
+    if p == 0:
+        return BONUS_BOUNDARY
+    prev, c = value[p - 1], value[p]
+    if not prev.isalnum():
+        return BONUS_BOUNDARY if c.isalnum() else 0
+    if (prev.islower() and c.isupper()) or \
+            (c.isdigit() and not prev.isdigit()):
+        return BONUS_CAMEL
+    return 0
+
+
+def max_score(n):
+    """Return highest :func:`raw_score` of a query of ``n`` characters"""
+    return (SCORE_MATCH * n + BONUS_BOUNDARY * BONUS_FIRST_CHAR_MULTIPLIER +
+            BONUS_BOUNDARY * (n - 1))
+
+
+def raw_score(value, positions):
+    """Return fzf score of the characters of ``value`` at ``positions``"""
+    score = 0
+    prev = None
+    # Bonus of the first character of the current run
+    first = 0
+    for k, p in enumerate(positions):
+        b = bonus(value, p)
+        if prev is not None and p == prev + 1:
+            # A run keeps the bonus of the character it started at
+            b = max(b, first, BONUS_CONSECUTIVE)
+        else:
+            if prev is not None:
+                score += SCORE_GAP_START + SCORE_GAP_EXTENSION * (p - prev - 2)
+            first = b
+        if k == 0:
+            b *= BONUS_FIRST_CHAR_MULTIPLIER
+        score += SCORE_MATCH + b
+        prev = p
+    return score
+
+
+def score(query, value, lower=None):
+    """Score how well ``query`` fuzzy-matches search key ``value``.
+
+    :param query: lower-case query
+    :type query: ``unicode``
+    :param value: search key
+    :type value: ``unicode``
+    :param lower: ``value.lower()``, if already known
+    :type lower: ``unicode``
+    :returns: score between 0 (no match) and 1 (``value`` starts with
+        ``query``)
+    :rtype: ``float``
+
+    """
+    if lower is None:
+        lower = value.lower()
+    if len(lower) != len(value):
+        # Lower-casing changed the length, so positions in `lower`
+        # aren't positions in `value`
+        value = lower
+    match = _align(query, lower, value)
+    if match is None:
+        return 0
+    # Every match scores something, however many gaps it has
+    return max(1, match[0]) / float(max_score(len(query)))
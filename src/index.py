@@ -20,11 +20,13 @@ import sys
 import os
 import sqlite3
 import csv
+from math import log1p
 from time import time
 
 from workflow import Workflow
 
 from config import INDEX_DB, DATA_FILE
+from fts import FOLDING_TOKENIZER
 
 log = None
 
@@ -39,34 +41,73 @@ def create_index_db():
     the fields you want to search to the search DB plus an ID (included here
     but unused) with which you can retrieve the full data from your full
     dataset.
+
+    Popularity data can't go in the virtual table (every column of an FTS
+    table is full-text indexed), so it lives in the ordinary `priors` table,
+    which shares its `docid` with `books`.
+
+    The `unicode61` tokenizer (if SQLite has it) folds case and diacritics,
+    so "bronte" finds "Brontë".
     """
     log.info('Creating index database')
     con = sqlite3.connect(INDEX_DB)
     with con:
         cur = con.cursor()
-        cur.execute(
-            "CREATE VIRTUAL TABLE books USING fts3(id, author, title, url)")
+        cur.execute("CREATE VIRTUAL TABLE books USING "
+                    "fts3(id, author, title, url, tokenize={})".format(
+                        FOLDING_TOKENIZER))
+        cur.execute("""CREATE TABLE priors
+                       (docid INTEGER PRIMARY KEY, downloads INTEGER,
+                        prior REAL)""")
+
+
+def read_data_file():
+    """Return list of `(id, author, title, url, downloads)` tuples
+
+    Older versions of `books.tsv` have no download counts, in which case
+    every book gets 0 downloads.
+    """
+    books = []
+    with open(DATA_FILE, 'rb') as file:
+        reader = csv.reader(file, delimiter=b'\t')
+        for row in reader:
+            row = [v.decode('utf-8') for v in row]
+            id_, author, title, url = row[:4]
+            downloads = int(row[4]) if len(row) > 4 and row[4] else 0
+            books.append((int(id_), author, title, url, downloads))
+    return books
 
 
 def update_index_db():
-    """Read in the data source and add it to the search index database"""
+    """Read in the data source and add it to the search index database
+
+    Books are inserted in order of popularity, so `docid` order is
+    also prior order: FTS returns matches in `docid` order, so a query
+    without `ORDER BY` sees the most popular books first and can stop
+    early once it has enough results.
+    """
     start = time()
     log.info('Updating index database')
+    books = read_data_file()
+    books.sort(key=lambda b: b[4], reverse=True)
+    # Log-scale the download counts to [0, 1], so a handful of
+    # hugely popular books don't flatten everything else to 0
+    top = log1p(books[0][4]) if books and books[0][4] else 1.0
     con = sqlite3.connect(INDEX_DB)
     count = 0
     with con:
         cur = con.cursor()
-        with open(DATA_FILE, 'rb') as file:
-            reader = csv.reader(file, delimiter=b'\t')
-            for row in reader:
-                id_, author, title, url = [v.decode('utf-8') for v in row]
-                id_ = int(id_)
-                cur.execute("""INSERT OR IGNORE INTO
-                            books (id, author, title, url)
-                            VALUES (?, ?, ?, ?)
-                            """, (id_, author, title, url))
-                # log.info('Added {} by {} to database'.format(title, author))
-                count += 1
+        for docid, (id_, author, title, url, downloads) in enumerate(books, 1):
+            cur.execute("""INSERT OR REPLACE INTO
+                        books (docid, id, author, title, url)
+                        VALUES (?, ?, ?, ?, ?)
+                        """, (docid, id_, author, title, url))
+            cur.execute("""INSERT OR REPLACE INTO
+                        priors (docid, downloads, prior)
+                        VALUES (?, ?, ?)
+                        """, (docid, downloads, log1p(downloads) / top))
+            # log.info('Added {} by {} to database'.format(title, author))
+            count += 1
     log.info('{} items added/updated in {:0.3} seconds'.format(
              count, time() - start))
 
@@ -2,25 +2,23 @@
 # encoding: utf-8
 from __future__ import print_function, unicode_literals
 
+import hashlib
+import heapq
+import multiprocessing
+import os
 import re
-import string
+import sqlite3
+import time
+from collections import OrderedDict, namedtuple
 
+import fuzzy
 import text
-from fts import FTSDatabase
-from workflow import Workflow
+from corpus import INITIALS, PreparedCorpus, charmask, split_on_delimiters
+from fts import FOLDING_TOKENIZER, FTSDatabase
+from workflow import FilterProfile, Workflow
 
 WF = Workflow()
 
-# TODO
-# Add fold_diacritics to FTSDatabase
-# Add min_score to FTSFilter
-
-# Anchor characters in a name
-INITIALS = string.ascii_uppercase + string.digits
-
-# Split on non-letters, numbers
-split_on_delimiters = re.compile('[^a-zA-Z0-9]').split
-
 # Match filter flags
 MATCH_STARTSWITH = 1
 MATCH_CAPITALS = 2
@@ -32,82 +30,1246 @@ MATCH_SUBSTRING = 32
 MATCH_ALLCHARS = 64
 MATCH_ALL = 127
 
-
-def filter(query, key=lambda x: x, ascending=False,
-               include_score=False, min_score=0, max_results=0,
-               match_on=MATCH_ALL, fold_diacritics=True):
-        pass
+# Unused hidden database files (see `FTSFilter`) older than this many
+# seconds are deleted
+MAX_DB_AGE = 7 * 24 * 60 * 60
+
+# Name of the hidden database files `FTSFilter` saves in the workflow
+# directory: a hex digest (or, for older versions, a `hash()` value)
+db_file_pattern = re.compile(r'^\.-?[0-9a-f]+\.db$').match
+
+# Tokens of a query word `FTSFilter` searches for: runs of letters and
+# digits. Anything else would be ``MATCH`` syntax, and the tokenizer
+# splits items on it anyway
+fts_tokens = re.compile(r'[^\W_]+', re.UNICODE).findall
+
+# Open `FTSDatabase` instances, keyed by dataset fingerprint and
+# tokenizer, least recently used first. Shared by all `FTSFilter`
+# instances, so the same dataset is only ever opened once per process
+_databases = OrderedDict()
+# Number of databases kept in `_databases`
+MAX_OPEN_DATABASES = 5
+# Number of `key` functions each `FTSFilter` remembers the database of
+KEY_CACHE_SIZE = 4
+
+# How `filter` chooses between `IterFilter` and `FTSFilter`.
+# Datasets with this many items or fewer always use `IterFilter`
+ITER_MAX_ITEMS = 1000
+# Bigger datasets use `IterFilter` if it is expected to take no more
+# than this many seconds, judging by how long it takes on a sample.
+# Otherwise `FTSFilter` is timed on the sample too, and the faster
+# one is used
+ITER_MAX_TIME = 0.05
+# Number of items in that sample
+SAMPLE_SIZE = 200
+# Rules `FTSFilter` doesn't support
+FTS_UNSUPPORTED = MATCH_ALLCHARS
+# Number of datasets `filter` keeps filters and timings for
+MAX_CACHED_DATASETS = 10
+
+# Backend chosen by `choose_backend`. ``backend`` is ``'iter'`` or
+# ``'fts'``, ``estimate`` the expected `IterFilter` time in seconds
+# and ``fts_estimate`` that of `FTSFilter`, including building its
+# database if need be (``None`` if not measured)
+Decision = namedtuple('Decision', 'backend size estimate fts_estimate reason')
+
+# Number of compiled query words (see `QueryMatcher`) each
+# `IterFilter` keeps
+MATCHER_CACHE_SIZE = 100
+# Number of prepared corpora (one per `key` function) each
+# `IterFilter` keeps
+CORPUS_CACHE_SIZE = 4
+
+# `IterFilter` only uses its process pool for datasets with at
+# least this many items. Below that, starting the tasks costs more
+# than scoring the items does
+PARALLEL_MIN_ITEMS = 20000
+# Number of chunks per process `IterFilter` splits a dataset into,
+# so that a process that finishes early can take another chunk
+CHUNKS_PER_PROCESS = 4
+# Number of process pools (one per prepared corpus) each `IterFilter`
+# keeps running
+POOL_CACHE_SIZE = 2
+
+# Tiers of rules `IterFilter.iter_filter` runs, in order. Together,
+# they must list the rules in the order `QueryMatcher.match` runs them
+TIERS = (MATCH_STARTSWITH | MATCH_CAPITALS | MATCH_ATOM,
+         MATCH_INITIALS,
+         MATCH_SUBSTRING,
+         MATCH_ALLCHARS)
+
+# `MATCH_*` rules in the order `QueryMatcher.match` runs them, with
+# their names in a `FilterProfile`
+RULE_NAMES = ((MATCH_STARTSWITH, 'startswith'),
+              (MATCH_CAPITALS, 'capitals'),
+              (MATCH_ATOM, 'atom'),
+              (MATCH_INITIALS_STARTSWITH, 'initials_startswith'),
+              (MATCH_INITIALS_CONTAIN, 'initials_contain'),
+              (MATCH_SUBSTRING, 'substring'),
+              (MATCH_ALLCHARS, 'allchars'))
+
+# Number of items `scan` scores between checks of its deadline
+DEADLINE_CHECK_INTERVAL = 64
+
+# Filters and samples used by `filter`, keyed
+# by ``id(items)``. Each entry also holds ``items``, so the id can't
+# be reused while it's in here, and its length and fingerprint, so
+# it's dropped when ``items`` changes
+_datasets = {}
+
+
+def filter(query, items, key=lambda x: x, ascending=False,
+           include_score=False, min_score=0, max_results=0,
+           match_on=MATCH_ALL, fold_diacritics=True, fingerprint=None,
+           fuzzy=False):
+    """Filter ``items`` with whichever of `IterFilter` and `FTSFilter`
+    is faster.
+
+    Arguments are the same as for :meth:`IterFilter.filter`. See
+    :func:`choose_backend` for how the backend is chosen; the decision
+    is logged at ``DEBUG`` level.
+
+    ``fingerprint`` is passed to :class:`FTSFilter` if that is used,
+    ``fuzzy`` to :class:`IterFilter`.
+
+    The filters are kept for the next call with the same ``items``.
+    They are rebuilt if the length of ``items`` or ``fingerprint``
+    changes, so pass a new ``fingerprint`` (or a new list) if you
+    change items in place.
+
+    Scores (and therefore ``min_score``) depend on the backend:
+    `FTSFilter` scores are based on SQLite's ``matchinfo``, and it ignores
+    :const:`MATCH_ALLCHARS`.
+
+    """
+    decision = choose_backend(query, items, key, match_on, fold_diacritics,
+                              fingerprint)
+    WF.logger.debug('Filtering %d items with %s (%s, estimate=%s, '
+                    'fts_estimate=%s)', decision.size, decision.backend,
+                    decision.reason, decision.estimate,
+                    decision.fts_estimate)
+    dataset = _dataset(items, fingerprint)
+    if decision.backend == 'iter':
+        if dataset['iter'] is None:
+            dataset['iter'] = IterFilter(items)
+        return dataset['iter'].filter(
+            query, key, ascending=ascending, include_score=include_score,
+            min_score=min_score, max_results=max_results,
+            match_on=match_on, fold_diacritics=fold_diacritics, fuzzy=fuzzy)
+
+    if dataset['fts'] is None:
+        dataset['fts'] = FTSFilter(items, fingerprint)
+    # `FTSFilter` has ``ascending`` the other way round
+    return dataset['fts'].filter(
+        query, key, include_score=include_score, min_score=min_score,
+        max_results=max_results, fold_diacritics=fold_diacritics,
+        ascending=not ascending, match_on=match_on)
+
+
+def choose_backend(query, items, key=lambda x: x, match_on=MATCH_ALL,
+                   fold_diacritics=True, fingerprint=None):
+    """Decide whether `IterFilter` or `FTSFilter` should filter ``items``.
+
+    `IterFilter` needs no set-up and supports all ``match_on`` rules,
+    so it is used for small datasets and wherever it's fast enough.
+    For larger datasets, it is timed on a sample of ``items`` with
+    ``query`` to estimate how long filtering everything would take,
+    plus preparing the data unless that's already been done. If that
+    is over :const:`ITER_MAX_TIME` and ``match_on`` contains rules
+    `FTSFilter` supports, `FTSFilter` is timed on the same sample, plus
+    building its database unless that's already been done, and
+    whichever is expected to be faster is used.
+
+    :returns: :class:`Decision`
+
+    """
+    size = len(items)
+    if size <= ITER_MAX_ITEMS:
+        return Decision('iter', size, None, None, 'small dataset')
+    if isinstance(key, (list, tuple)):
+        return Decision('iter', size, None, None, 'multiple fields')
+    if not match_on & ~FTS_UNSUPPORTED:
+        return Decision('iter', size, None, None,
+                        'rules not supported by FTS')
+
+    dataset = _dataset(items, fingerprint)
+    samples = dataset['samples'].get(key)
+    if samples is None:
+        samples = dataset['samples'][key] = _Samples(items, key)
+
+    estimate = samples.time_iter(query, match_on, fold_diacritics) * size
+    if dataset['iter'] is None or key not in dataset['iter']._corpora:
+        estimate += samples.prepare_cost * size
+    if estimate <= ITER_MAX_TIME:
+        return Decision('iter', size, estimate, None, 'fast enough')
+
+    fts_estimate = samples.time_fts(query, match_on) * size
+    if not _fts_built(dataset, key, fingerprint):
+        fts_estimate += samples.build_cost * size
+    if estimate <= fts_estimate:
+        return Decision('iter', size, estimate, fts_estimate,
+                        'faster than FTS')
+    reason = 'too slow'
+    if match_on & FTS_UNSUPPORTED:
+        reason += ', ignoring MATCH_ALLCHARS'
+    return Decision('fts', size, estimate, fts_estimate, reason)
+
+
+class _Samples(object):
+    """`IterFilter` and `FTSFilter` on a sample of :const:`SAMPLE_SIZE`
+    items, for `choose_backend` to time"""
+
+    def __init__(self, items, key):
+        self.key = key
+        sample = items[::max(1, len(items) // SAMPLE_SIZE)][:SAMPLE_SIZE]
+        self.size = len(sample)
+        # Preparing the data and building the database are one-off
+        # costs, so they're timed separately, per item
+        start = time.time()
+        self.iter = IterFilter(sample)
+        self.iter.prepare(key)
+        self.prepare_cost = (time.time() - start) / self.size
+        # In memory, so nothing is left on disk
+        start = time.time()
+        db = FilterDatabase([key(item) for item in sample])
+        db.create()
+        self.build_cost = (time.time() - start) / self.size
+        self.fts = FTSFilter(sample)
+        self.fts._key_databases[key] = db
+
+    def time_iter(self, query, match_on, fold_diacritics):
+        """Return per-item time of `IterFilter` with ``query``"""
+        start = time.time()
+        self.iter.filter(query, self.key, match_on=match_on,
+                         fold_diacritics=fold_diacritics)
+        return (time.time() - start) / self.size
+
+    def time_fts(self, query, match_on):
+        """Return per-item time of `FTSFilter` with ``query``"""
+        start = time.time()
+        self.fts.filter(query, self.key, match_on=match_on)
+        return (time.time() - start) / self.size
+
+
+def _fts_built(dataset, key, fingerprint=None):
+    """Whether the `FTSFilter` database for ``dataset`` and ``key``
+    already exists, so using it costs nothing to build"""
+    fts = dataset['fts']
+    if fts is not None and key in fts._key_databases:
+        return True
+    if fingerprint is None:
+        # Finding the file means reading every item
+        return False
+    return os.path.exists(FTSFilter(dataset['items'],
+                                    fingerprint)._database_file())
+
+
+def _dataset(items, fingerprint=None):
+    """Return `filter`'s cache entry for ``items``, replacing it if
+    ``items`` or ``fingerprint`` has changed"""
+    dataset = _datasets.get(id(items))
+    if (dataset is None or dataset['items'] is not items or
+            dataset['size'] != len(items) or
+            dataset['fingerprint'] != fingerprint):
+        if dataset is not None and dataset['iter'] is not None:
+            dataset['iter'].close()
+        if len(_datasets) >= MAX_CACHED_DATASETS:
+            _datasets.clear()
+        dataset = {'items': items, 'size': len(items),
+                   'fingerprint': fingerprint, 'iter': None, 'fts': None,
+                   'samples': {}}
+        _datasets[id(items)] = dataset
+    return dataset
+
+
+def fingerprint(data):
+    """Return a hex digest of the contents of ``data``.
+
+    Unlike :func:`hash`, the digest is stable between processes, so it
+    can be used to name files.
+
+    :param data: items to fingerprint
+    :type data: iterable
+    :returns: hex digest
+    :rtype: ``unicode``
+
+    """
+    h = hashlib.md5()
+    for item in data:
+        h.update(repr(item).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def collect_garbage(keep=(), max_age=MAX_DB_AGE):
+    """Delete stale hidden `FTSFilter` database files.
+
+    :param keep: paths of database files that must not be deleted
+    :type keep: iterable
+    :param max_age: delete files that haven't been used in this many
+        seconds
+    :type max_age: ``int``
+    :returns: number of files deleted
+    :rtype: ``int``
+
+    """
+    keep = set(keep) | set(db.file for db in _databases.values())
+    dirpath = WF.workflowdir
+    cutoff = time.time() - max_age
+    count = 0
+    for filename in os.listdir(dirpath):
+        if not db_file_pattern(filename):
+            continue
+        path = os.path.join(dirpath, filename)
+        if path in keep:
+            continue
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.unlink(path)
+                count += 1
+        except OSError:  # Deleted by another process
+            continue
+    return count
+
+
+class FilterDatabase(FTSDatabase):
+    """`FTSDatabase` that also indexes the capitals and initials of items.
+
+    Besides ``data``, each row has the columns:
+
+    - ``capitals``: the capital letters and digits of the item
+      (``gc`` for "Google Chrome")
+    - ``initials``: first letters of the item's "atoms" (``himym``
+      for "How I Met Your Mother")
+    - ``initials_contain``: every suffix of ``initials``, so a prefix
+      query on this column matches anywhere in the initials (``doh``
+      matches "The Dukes of Hazzard")
+
+    These are what `IterFilter` uses for the ``MATCH_CAPITALS`` and
+    ``MATCH_INITIALS_*`` rules. Here they're calculated once when the
+    database is built.
+
+    ``data`` is tokenized with :const:`~fts.FOLDING_TOKENIZER`, so
+    SQLite folds diacritics in items and queries, like `IterFilter`
+    does for ASCII queries. Pass :const:`STEMMING_TOKENIZER` as
+    ``tokenizer`` to match words by their stems instead (``run``
+    matches "running"), but without folding diacritics.
+
+    The table is FTS4, as FTS3 ignores the ``^`` that anchors a token
+    to the start of a column (which ``MATCH_STARTSWITH`` needs).
+
+    """
+    FIELDS = 'id, data, capitals, initials, initials_contain'
+    TOKENIZER = FOLDING_TOKENIZER
+    STEMMING_TOKENIZER = 'porter'
+    MODULE = 'fts4'
+
+    def __init__(self, data, file=None, tokenizer=None):
+        super(FilterDatabase, self).__init__(
+            data, file, tokenizer=tokenizer or self.TOKENIZER)
+        self.fields = self.FIELDS
+
+    def _prepare_values(self, i, item):
+        # Like `IterFilter`, match capitals and initials on ASCII
+        value = text.fold_to_ascii(item)
+        capitals = ''.join([c for c in value if c in INITIALS])
+        atoms = [s.lower() for s in split_on_delimiters(value) if s]
+        initials = ''.join([s[0] for s in atoms])
+        suffixes = ' '.join([initials[j:] for j in range(len(initials))])
+        return [i, item, capitals.lower(), initials, suffixes]
 
 
 class FTSFilter(object):
-    def __init__(self, data):
+    def __init__(self, data, fingerprint=None, stemming=False):
+        """Filter ``data`` using an SQLite full-text search database.
+
+        The database is saved in the workflow directory, named after a
+        fingerprint of the indexed search keys. Computing it means reading
+        the whole of ``data``, so if you have a cheaper way to tell whether
+        your data has changed (e.g. the mtime and size of the file it was
+        read from), pass that as ``fingerprint``. It must also change if
+        you change the ``key`` passed to :meth:`filter`.
+
+        Without ``fingerprint``, the database is looked up by ``key``, so
+        pass the same function each time, not a new ``lambda``.
+
+        Words are matched with diacritics folded. With ``stemming``, they
+        are matched by their stems instead (see `FilterDatabase`).
+
+        :param data: items to filter
+        :type data: ``list`` or ``tuple``
+        :param fingerprint: string that changes when ``data`` does
+        :type fingerprint: ``unicode``
+        :param stemming: match words by their stems
+        :type stemming: ``Boolean``
+
+        """
         self.data = data
+        self._tokenizer = FilterDatabase.TOKENIZER
+        if stemming:
+            self._tokenizer = FilterDatabase.STEMMING_TOKENIZER
+        if fingerprint is not None:
+            fingerprint = hashlib.md5(fingerprint.encode('utf-8')).hexdigest()
+        self._fingerprint = fingerprint
+        # `FilterDatabase` per `key` function, least recently used
+        # first, so neither the search keys nor their fingerprint are
+        # calculated more than once
+        self._key_databases = OrderedDict()
 
     def filter(self, query, key=lambda x: x,
-               include_score=False, max_results=0, fold_diacritics=True,
-               ascending=True, match_on=MATCH_ALL):
-        db_file = self._memoize_database(self.data)
-        fts = FTSDatabase(self.data, db_file)
-        fts.tokenizer = 'porter'
-
-        results = {}
-        matched = []
-        words = [s.strip() for s in query.split(' ')]
-        # Search this virtual table using the various match patters
-        # This part of the function will be greatly refactored.
+               include_score=False, min_score=0, max_results=0,
+               fold_diacritics=True, ascending=True, match_on=MATCH_ALL):
+        fts = self._memoize_database(key)
+
+        words = [s.strip() for s in query.split(' ') if s.strip()]
+        if not words:
+            return []
+        # Like `IterFilter`, each word may match by a different rule
+        word_rules = [self._rules(word, match_on) for word in words]
+        if not all(word_rules):
+            return []
+
+        # Scores are scaled by 1000 for the caller, hence `min_score`
+        try:
+            rows = fts.search_words(word_rules, limit=max_results,
+                                    min_score=min_score / 1000.0,
+                                    ascending=not ascending)
+        except sqlite3.OperationalError as err:
+            if 'malformed MATCH' not in str(err):
+                raise
+            return []
+        # Rows are ``score, id, ..., rule``: Python 2's `sqlite3.Row`
+        # can't be indexed by unicode names, nor Python 3's by bytes
+        results = [(self.data[int(row[1])], row[0] * 1000, row[-1])
+                   for row in rows]
+
+        # return list of ``(item, score, rule)``
+        if include_score:
+            return results
+        # just return list of items
+        return [t[0] for t in results]
+
+    def _rules(self, word, match_on):
+        """Return ``(rule, query)`` tuples for query word ``word``.
+
+        Rules are in order of priority, as the first one wins if several
+        give an item the same score.
+
+        """
+        words = [word]
+        rules = []
+        if match_on & MATCH_STARTSWITH:
+            # `^` anchors the word to the start of the column
+            rules.append((MATCH_STARTSWITH, self._column_query(
+                'data', words, True, anchor=True)))
+        if match_on & MATCH_CAPITALS:
+            rules.append((MATCH_CAPITALS,
+                          self._column_query('capitals', words, True)))
+        if match_on & MATCH_ATOM:
+            rules.append((MATCH_ATOM, self._column_query('data', words)))
+        if match_on & MATCH_INITIALS_STARTSWITH:
+            rules.append((MATCH_INITIALS_STARTSWITH,
+                          self._column_query('initials', words, True)))
+        if match_on & MATCH_INITIALS_CONTAIN:
+            rules.append((MATCH_INITIALS_CONTAIN,
+                          self._column_query('initials_contain', words,
+                                             True)))
         if match_on & MATCH_SUBSTRING:
             # not fully implemented
             # won't match `x{query}z`
-            sql_query = ' '.join([w + '*' for w in words])
-            matches = fts.search(sql_query)
-            matched += [list(m) + [MATCH_SUBSTRING] for m in matches]
-        if match_on & MATCH_STARTSWITH:
-            sql_query = '^' + ' '.join(words)
-            matches = fts.search(sql_query)
-            matched += [list(m) + [MATCH_STARTSWITH] for m in matches]
-        if match_on & MATCH_ATOM:
-            sql_query = ' '.join(words)
-            matches = fts.search(sql_query)
-            matched += [list(m) + [MATCH_ATOM] for m in matches]
+            rules.append((MATCH_SUBSTRING,
+                          self._column_query('data', words, True)))
+        # Words without letters or digits have no query
+        return [(rule, q) for rule, q in rules if q]
 
-        queue = set()
-        for item in matched:
-            score, id_, data, flag = item
-            if id_ not in queue:
-                results[(score, id_)] = (data, (score * 1000), flag)
-                queue.add(id_)
+    @staticmethod
+    def _column_query(column, words, prefix=False, anchor=False):
+        """Return ``MATCH`` query for ``words`` in ``column`` only.
 
-        # sort on keys, then discard the keys
-        keys = sorted(results.keys(), reverse=ascending)
-        results = [results.get(k) for k in keys]
+        Only the letters and digits of ``words`` are searched for (see
+        :data:`fts_tokens`), so user input can't be ``MATCH`` syntax.
 
-        if max_results and len(results) > max_results:
-            results = results[:max_results]
+        If ``prefix`` is ``True``, ``words`` are prefixes of tokens.
+        If ``anchor`` is ``True``, the first word must be the first
+        token of the column.
+
+        :returns: query or ``None`` if ``words`` have no tokens
+        :rtype: ``unicode``
+
+        """
+        tokens = []
+        for word in words:
+            tokens.extend(fts_tokens(word.lower()))
+        if not tokens:
+            return None
+        fmt = '{}:{}*' if prefix else '{}:{}'
+        terms = [fmt.format(column, t) for t in tokens]
+        if anchor:
+            terms[0] = terms[0].replace(':', ':^', 1)
+        return ' '.join(terms)
+
+    def _memoize_database(self, key):
+        """Return the `FilterDatabase` for :attr:`data` and ``key``.
+
+        The database file is saved so that successive searches on the same
+        dataset have the data cached (in sqlite format), for speed, and the
+        open database is kept in :data:`_databases`, so the connection is
+        reused by later calls in the same process.
+
+        With a ``fingerprint``, the search keys are only calculated if
+        the database has to be built.
+
+        """
+        fts = self._key_databases.pop(key, None)
+        if fts is None:
+            fts = self._open_database(key)
+            if len(self._key_databases) >= KEY_CACHE_SIZE:
+                self._key_databases.popitem(last=False)
+        self._key_databases[key] = fts
+        return fts
+
+    def _database_file(self, fp=None):
+        """Return path of the database file for fingerprint ``fp``
+        (default: the one passed to the constructor)"""
+        # Hidden database file with fingerprint as name. The columns
+        # are part of the name, so that adding columns doesn't mean
+        # opening an old database that doesn't have them
+        name = hashlib.md5(((fp or self._fingerprint) +
+                            FilterDatabase.FIELDS + self._tokenizer +
+                            FilterDatabase.MODULE).encode('utf-8'))
+        return WF.workflowfile('.' + name.hexdigest() + '.db')
+
+    def _open_database(self, key):
+        """Return `FilterDatabase` for :attr:`data` and ``key`` from
+        :data:`_databases`, opening or building it if need be"""
+        if self._fingerprint is not None:
+            fp = self._fingerprint
+            # Only read if the database has to be built
+            values = (key(item) for item in self.data)
+        else:
+            values = [key(item) for item in self.data]
+            fp = fingerprint(values)
+        fts = _databases.pop((fp, self._tokenizer), None)
+        if fts is None:
+            db_file = self._database_file(fp)
+            fts = FilterDatabase(values, db_file, self._tokenizer)
+            if len(_databases) >= MAX_OPEN_DATABASES:
+                # Closed when no `FTSFilter` uses it any more
+                _databases.popitem(last=False)
+            # Mark the file as in use, then delete any that aren't
+            if os.path.exists(db_file):
+                os.utime(db_file, None)
+            collect_garbage(keep=[db_file])
+        _databases[(fp, self._tokenizer)] = fts
+        return fts
+
+
+class Deadline(object):
+    """Time by which a filter must return.
+
+    :param timeout: seconds from now
+    :type timeout: ``float``
+
+    """
+
+    def __init__(self, timeout):
+        self.time = time.time() + timeout
+        #: Whether :meth:`check` has found the deadline passed
+        self.expired = False
+
+    def check(self):
+        """Return ``True`` if the deadline has passed"""
+        if not self.expired and time.time() >= self.time:
+            self.expired = True
+        return self.expired
+
+
+class TopK(object):
+    """Collect the ``k`` smallest (or largest) ``(key, result)`` pairs.
+
+    Uses a heap of size ``k``, so collecting from ``n`` pairs
+    is ``O(n log k)``, not the ``O(n log n)`` of sorting them all.
+
+    :param k: number of results to keep
+    :type k: ``int``
+    :param largest: keep the largest keys instead of the smallest
+    :type largest: ``Boolean``
+
+    """
+
+    def __init__(self, k, largest=False):
+        self.k = k
+        self.largest = largest
+        self._heap = []
+
+    def __len__(self):
+        return len(self._heap)
+
+    @property
+    def worst(self):
+        """Result that will be dropped next, or ``None`` if not full"""
+        if len(self._heap) < self.k:
+            return None
+        return self._heap[0][-1]
+
+    def push(self, key, result):
+        """Offer ``result`` with sort key ``key``.
+
+        :returns: ``True`` if :attr:`worst` (may have) changed, i.e.
+            the heap is full and ``result`` was kept
+
+        """
+        if self.largest:
+            entry = (key, result)
+        else:
+            entry = (_Reversed(key), result)
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+            return len(self._heap) == self.k
+        if self._heap[0] < entry:
+            heapq.heapreplace(self._heap, entry)
+            return True
+        return False
+
+    def results(self):
+        """Return kept results, ordered by key"""
+        # Smallest keys are the largest `_Reversed` keys
+        return [entry[-1] for entry in sorted(self._heap, reverse=True)]
+
+
+class _Reversed(object):
+    """Wrap a sort key to reverse its order, making `heapq`'s min-heap
+    a max-heap"""
+
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+class QueryMatcher(object):
+    """One word of a query, compiled for matching against the search keys
+    of a :class:`~corpus.PreparedCorpus`.
+
+    Everything about the word that the ``MATCH_*`` rules need is worked
+    out here once per query, not once per item.
+
+    :param word: query word
+    :type word: ``unicode``
+    :param fold_diacritics: match on ASCII-folded search keys if ``word``
+        is ASCII
+    :type fold_diacritics: ``Boolean``
+    :param fuzzy: score :const:`MATCH_ALLCHARS` with :func:`fuzzy.score`
+        instead of by the position and span of the leftmost match
+    :type fuzzy: ``Boolean``
+
+    """
+
+    def __init__(self, word, fold_diacritics=True, fuzzy=False):
+        self.query = word.lower()
+        self.mask = charmask(self.query)
+        self.isascii = text.isascii(self.query)
+        self.fold_diacritics = fold_diacritics and self.isascii
+        self.fuzzy = fuzzy
+        # Build pattern: include all characters
+        pattern = []
+        for c in self.query:
+            pattern.append('[^{0}]*{0}'.format(re.escape(c)))
+        pattern = ''.join(pattern)
+        self.search = re.compile(pattern, re.IGNORECASE).search
+
+    def view(self, corpus):
+        """Return the :class:`~corpus.View` of ``corpus`` to match on"""
+        if self.fold_diacritics:
+            return corpus.folded
+        return corpus.raw
+
+    def candidates(self, view, match_on, start=0, stop=None):
+        """Return indices of items ``start`` to ``stop`` of ``view``
+        that rules ``match_on`` other than :const:`MATCH_ALLCHARS` might
+        match.
+
+        Items that could only match :const:`MATCH_ALLCHARS` are left
+        out, as its matches needn't contain any n-gram of the query.
+
+        :returns: sorted indices or ``None`` if ``view`` has no
+            :class:`~corpus.NgramIndex`
+        :rtype: ``list``
+
+        """
+        index = view.ngram_index()
+        if index is None:
+            return None
+        hits = []
+        if match_on & (MATCH_STARTSWITH | MATCH_ATOM | MATCH_SUBSTRING):
+            # These rules all need `query` to be a substring of the item
+            if len(self.query) >= index.n:
+                hits = index.search(self.query, start, stop)
+            else:
+                hits = view.candidates(self.mask, start, stop)
+        if match_on & (MATCH_CAPITALS | MATCH_INITIALS):
+            more = view.candidates(self.mask, start, stop,
+                                   view.initial_masks)
+            hits = sorted(set(hits).union(more))
+        return hits
+
+    def bound(self, view, i, match_on):
+        """Return the highest score rules ``match_on`` could give item
+        ``i`` of ``view``.
+
+        This only depends on lengths, so is much cheaper than running
+        the rules.
+
+        """
+        n = len(self.query)
+        best = 0
+        if match_on & (MATCH_STARTSWITH | MATCH_ATOM):
+            best = 100.0 - (len(view.values[i]) / n)
+        elif match_on & MATCH_SUBSTRING:
+            best = 90.0 - (len(view.values[i]) / n)
+        if match_on & MATCH_CAPITALS:
+            best = max(best, 100.0 - (len(view.capitals[i]) / n))
+        if match_on & MATCH_INITIALS_STARTSWITH:
+            best = max(best, 100.0 - (len(view.initials[i]) / n))
+        elif match_on & MATCH_INITIALS_CONTAIN:
+            best = max(best, 95.0 - (len(view.initials[i]) / n))
+        if match_on & MATCH_ALLCHARS:
+            # The match is at least as long as `query`
+            best = max(best, 100.0 / (n + 1))
+        return best
+
+    def match(self, view, i, match_on, floor=0):
+        """Filter item ``i`` of ``view`` using rules ``match_on``
+
+        If ``floor`` is positive, stop as soon as none of the remaining
+        rules could give a score of ``floor`` or higher. (Rules that
+        can't must still be run while earlier rules might match, as
+        a lower-scoring earlier rule takes priority.)
+
+        Items that don't contain all the characters of the query should
+        already have been filtered out (see :func:`scan`).
+
+        :returns: ``(score, rule)``
+
+        """
+        score, rule = self._match(view, i, match_on, floor)
+        if score > 0:
+            return (score, rule)
+        return (0, None)
+
+    def _match(self, view, i, match_on, floor=0):
+        """Implement :meth:`match`, but return the score of the first
+        rule that matches even if it's 0 or less"""
+        query = self.query
+        rule = None
+        score = 0
+
+        value = view.values[i]
+        lower = view.lowers[i]
+
+        if floor > 0 and self.bound(view, i, match_on) < floor:
+            return (0, None)
+        # item starts with query
+        if (match_on & MATCH_STARTSWITH and
+                lower.startswith(query)):
+            score = 100.0 - (len(value) / len(query))
+            rule = MATCH_STARTSWITH
+
+        if not score and match_on & MATCH_CAPITALS:
+            # query matches capitalised letters in item,
+            # e.g. of = OmniFocus
+            capitals = view.capitals[i]
+            if capitals.startswith(query):
+                score = 100.0 - (len(capitals) / len(query))
+                rule = MATCH_CAPITALS
+
+        if (not score and floor > 0 and
+                self.bound(view, i, match_on & ~(MATCH_STARTSWITH |
+                                                 MATCH_CAPITALS)) < floor):
+            return (0, None)
+
+        if not score and match_on & MATCH_ATOM:
+            # is `query` one of the atoms in item?
+            # similar to substring, but scores more highly, as it's
+            # a word within the item
+            if ' ' + query + ' ' in view.atoms[i]:
+                score = 100.0 - (len(value) / len(query))
+                rule = MATCH_ATOM
+
+        if not score:
+            # `query` matches start (or all) of the initials of the
+            # atoms, e.g. ``himym`` matches "How I Met Your Mother"
+            # *and* "how i met your mother" (the ``capitals`` rule only
+            # matches the former)
+            initials = view.initials[i]
+            if (match_on & MATCH_INITIALS_STARTSWITH and
+                    initials.startswith(query)):
+                score = 100.0 - (len(initials) / len(query))
+                rule = MATCH_INITIALS_STARTSWITH
+
+            # `query` is a substring of initials, e.g. ``doh`` matches
+            # "The Dukes of Hazzard"
+            elif (match_on & MATCH_INITIALS_CONTAIN and
+                    query in initials):
+                score = 95.0 - (len(initials) / len(query))
+                rule = MATCH_INITIALS_CONTAIN
+
+        if (not score and floor > 0 and
+                self.bound(view, i, match_on & (MATCH_SUBSTRING |
+                                                MATCH_ALLCHARS)) < floor):
+            return (0, None)
+
+        if not score:
+            # `query` is a substring of item
+            if match_on & MATCH_SUBSTRING and query in lower:
+                    score = 90.0 - (len(value) / len(query))
+                    rule = MATCH_SUBSTRING
+
+        if (not score and floor > 0 and
+                self.bound(view, i, match_on & MATCH_ALLCHARS) < floor):
+            return (0, None)
+
+        if not score:
+            # finally, assign a score based on how close together the
+            # characters in `query` are in item.
+            if match_on & MATCH_ALLCHARS and self.fuzzy:
+                # Scaled to the range of the regex scores below
+                score = (fuzzy.score(query, value, lower) * 100.0 /
+                         (len(query) + 1))
+                if score:
+                    rule = MATCH_ALLCHARS
+            elif match_on & MATCH_ALLCHARS:
+                match = self.search(value)
+                if match:
+                    score = 100.0 / ((1 + match.start()) *
+                                     (match.end() - match.start() + 1))
+                    rule = MATCH_ALLCHARS
+
+        return (score, rule)
+
+    def profile_match(self, view, i, match_on, profile):
+        """Like :meth:`match`, but run the rules one at a time and
+        record each in ``profile``.
+
+        As :meth:`match` stops at the first rule that matches, even if
+        its score is 0 or less, the result is the same (but no rules
+        are skipped for being unable to beat a score).
+
+        :param profile: where to record rules
+        :type profile: :class:`~workflow.workflow.FilterProfile`
+
+        """
+        t = time.time()
+        for rule, name in RULE_NAMES:
+            if match_on & rule:
+                score, r = self._match(view, i, rule)
+                t = profile.record(name, score, t)
+                if score:
+                    if score > 0:
+                        return (score, r)
+                    break
+        return (0, None)
 
-        # return list of ``(score, item, rule)``
-        if include_score:
-            return results
-        # just return list of items
-        return [t[0] for t in results]
 
-    def _memoize_database(self, data):
-        # Get hash value of iterable ``data``
-        items_hash = str(hash(frozenset(data)))
-        # Prepare hidden database file with hash value as name
-        hidden_db = '.' + items_hash + '.db'
-        # Save the database file so that successive searches on the same
-        # dataset have the data cached (in sqlite format), for speed.
-        return WF.workflowfile(hidden_db)
+def scan(corpus, matchers, match_on=MATCH_ALL, min_score=0, max_results=0,
+         ascending=False, start=0, stop=None, skip=None, deadline=None,
+         profile=None):
+    """Score items ``start`` to ``stop`` of ``corpus`` against a query.
+
+    This is the inner loop of :meth:`IterFilter.filter`.
+
+    :param corpus: prepared search keys
+    :type corpus: :class:`~corpus.PreparedCorpus`
+    :param matchers: one `QueryMatcher` per query word
+    :type matchers: ``list``
+    :param skip: indices of items not to score
+    :type skip: ``set``
+    :param deadline: stop scoring items when this passes, setting its
+        ``expired`` attribute
+    :type deadline: :class:`Deadline`
+    :param profile: record the rules run here
+    :type profile: :class:`~workflow.workflow.FilterProfile`
+    :returns: ``(key, i, score, rule)`` tuples ordered by sort key
+        ``key`` (reversed if ``ascending``), where ``i`` is the item's
+        index in ``corpus``
+    :rtype: ``list``
+
+    """
+    # Each word with the version of the search keys it's matched on
+    matchers = [(m, m.view(corpus)) for m in matchers]
+    if stop is None:
+        stop = len(corpus)
+    if profile is not None:
+        t = time.time()
+
+    # pre-filter any items that do not contain all characters
+    # of the query to save on running the rules on them
+    masks = {}
+    for matcher, view in matchers:
+        masks[view] = masks.get(view, 0) | matcher.mask
+    candidates = None
+    for view, mask in masks.items():
+        survivors = view.candidates(mask, start, stop)
+        if candidates is None:
+            candidates = survivors
+        else:
+            candidates = sorted(set(candidates) & set(survivors))
+    if candidates is None:  # No query
+        candidates = []
+    if skip:
+        candidates = [i for i in candidates if i not in skip]
+    if profile is not None:
+        profile.add('prefilter', stop - start, len(candidates),
+                    time.time() - t)
+
+    # With n-gram indices, split off the items that can match the
+    # other rules and score them first. The rest can only match
+    # `MATCH_ALLCHARS` on some word, so are skipped if that can't
+    # beat the results collected from the first lot
+    batches = [candidates]
+    tail_bound = None
+    strong = None
+    for matcher, view in matchers:
+        hits = matcher.candidates(view, match_on, start, stop)
+        if hits is None:
+            strong = None
+            break
+        if strong is None:
+            strong = hits
+        else:
+            hits = set(hits)
+            strong = [i for i in strong if i in hits]
+    if strong is not None and skip:
+        strong = [i for i in strong if i not in skip]
+    if strong is not None:
+        if match_on & MATCH_ALLCHARS:
+            hits = set(strong)
+            batches = [strong, [i for i in candidates if i not in hits]]
+            tail_bound = (100.0 * (len(matchers) - 1) +
+                          max([100.0 / (len(m.query) + 1)
+                               for m, _ in matchers]))
+        else:
+            batches = [strong]
+
+    if max_results:
+        collector = TopK(max_results, largest=ascending)
+    else:
+        collector = None
+        results = []
+    # Items must score more than `floor` to be included. It rises
+    # from `min_score` to the score of the worst result in
+    # `collector` once that is full (if best results are wanted).
+    # Rules that can't beat it aren't run (see `QueryMatcher.match`)
+    floor = min_score
+    # Highest score the words after word `j` can add, plus a little
+    # slack, so rounding errors in `floor - score` can't prune items
+    # that tie with the worst result
+    rest = [100.0 * (len(matchers) - j - 1) + 1e-9
+            for j in range(len(matchers))]
+
+    for n, batch in enumerate(batches):
+        if n and tail_bound + 1e-9 < floor:
+            break
+        if deadline is not None and deadline.check():
+            break
+        for count, i in enumerate(batch, 1):
+            if (deadline is not None and
+                    not count % DEADLINE_CHECK_INTERVAL and deadline.check()):
+                break
+            score = 0
+            for j, (matcher, view) in enumerate(matchers):
+                if profile is not None:
+                    s, r = matcher.profile_match(view, i, match_on, profile)
+                else:
+                    s, r = matcher.match(view, i, match_on,
+                                         floor - score - rest[j])
+
+                if not s:  # Skip items that don't match part of the query
+                    break
+                score += s
+
+            else:
+                if score > min_score:
+                    # use "reversed" `score` (i.e. highest becomes lowest)
+                    # and `value` as sort key. This means items with the
+                    # same score will be sorted in alphabetical not
+                    # reverse alphabetical order
+                    key = (100.0 / score, corpus.raw.lowers[i], i)
+                    result = (key, i, score, r)
+                    if collector is None:
+                        results.append(result)
+                    elif collector.push(key, result) and not ascending:
+                        floor = max(min_score, collector.worst[2])
+
+    if collector is None:
+        results.sort(reverse=ascending)
+        return results
+    return collector.results()
+
+
+def scan_fields(corpora, weights, matchers, match_on=MATCH_ALL, min_score=0,
+                max_results=0, ascending=False, deadline=None, profile=None):
+    """Score the items of ``corpora`` against a query on several fields.
+
+    Each word of the query is matched on every field, and counts with
+    the highest weighted score it gets. All words must match, but not
+    necessarily on the same field.
+
+    :param corpora: one :class:`~corpus.PreparedCorpus` of the same
+        items per field
+    :type corpora: ``list``
+    :param weights: number to multiply each field's scores by
+    :type weights: ``list``
+    :param matchers: one `QueryMatcher` per query word
+    :type matchers: ``list``
+    :param deadline: stop scoring items when this passes
+    :type deadline: :class:`Deadline`
+    :param profile: record the rules run here
+    :type profile: :class:`~workflow.workflow.FilterProfile`
+    :returns: ``(key, i, score, rule, field)`` tuples ordered like the
+        results of :func:`scan`, where ``rule`` and ``field`` (an index
+        into ``corpora``) are those of the best-scoring word
+    :rtype: ``list``
+
+    """
+    # The views of each field each word is matched on
+    views = [[m.view(c) for c in corpora] for m in matchers]
+
+    if profile is not None:
+        t = time.time()
+
+    # Items that contain all of some word's characters in no field
+    # can't match
+    candidates = None
+    for matcher, fields in zip(matchers, views):
+        hits = set()
+        for view in fields:
+            hits.update(view.candidates(matcher.mask))
+        if candidates is None:
+            candidates = hits
+        else:
+            candidates &= hits
+    candidates = sorted(candidates or ())
+    if profile is not None:
+        profile.add('prefilter', len(corpora[0]), len(candidates),
+                    time.time() - t)
+
+    if max_results:
+        collector = TopK(max_results, largest=ascending)
+    else:
+        collector = None
+        results = []
+
+    for count, i in enumerate(candidates, 1):
+        if (deadline is not None and
+                not count % DEADLINE_CHECK_INTERVAL and deadline.check()):
+            break
+        score = 0
+        best = (0, None, None)
+        for matcher, fields in zip(matchers, views):
+            word = (0, None, None)
+            for field, view in enumerate(fields):
+                if view.masks[i] & matcher.mask != matcher.mask:
+                    continue
+                if profile is not None:
+                    s, r = matcher.profile_match(view, i, match_on, profile)
+                else:
+                    s, r = matcher.match(view, i, match_on)
+                s *= weights[field]
+                if s > word[0]:
+                    word = (s, r, field)
+
+            if not word[0]:  # Skip items that don't match part of the query
+                break
+            score += word[0]
+            if word[0] > best[0]:
+                best = word
+
+        else:
+            if score > min_score:
+                _, rule, field = best
+                key = (100.0 / score, corpora[field].raw.lowers[i], i)
+                result = (key, i, score, rule, field)
+                if collector is None:
+                    results.append(result)
+                else:
+                    collector.push(key, result)
+
+    if collector is None:
+        results.sort(reverse=ascending)
+        return results
+    return collector.results()
+
+
+# State of `IterFilter` pool worker processes. Set by `_init_worker`
+_worker = {}
+
+
+def _init_worker(corpus):
+    """Initialise pool worker process with the corpus it filters"""
+    _worker['corpus'] = corpus
+    # For its cache of compiled query words
+    _worker['filter'] = IterFilter([])
+
+
+def _scan_chunk(task):
+    """Run `scan` in a pool worker process.
+
+    Returns its results and whether ``deadline`` expired.
+
+    Query words are compiled here, as compiled regexes can't be sent
+    between processes.
+
+    """
+    (words, fold_diacritics, fuzzy, match_on, min_score, max_results,
+     ascending, start, stop, skip, deadline) = task
+    matchers = [_worker['filter']._compile(word, fold_diacritics, fuzzy)
+                for word in words]
+    results = scan(_worker['corpus'], matchers, match_on, min_score,
+                   max_results, ascending, start, stop, skip, deadline)
+    return results, deadline is not None and deadline.expired
 
 
 class IterFilter(object):
-    def __init__(self, data):
+    def __init__(self, data, processes=1, ngrams=False):
+        """Filter ``data`` in Python.
+
+        If ``processes`` is more than 1 (or 0, meaning one per CPU),
+        datasets of :const:`PARALLEL_MIN_ITEMS` or more items are split
+        between a pool of that many processes. The pool is started on
+        the first such call to :meth:`filter` and kept until
+        :meth:`close` is called. Each process gets a copy of the
+        prepared data when the pool starts, so only queries and results
+        are sent between processes afterwards.
+
+        If ``ngrams`` is ``True``, the prepared data get a trigram index
+        (see :class:`~corpus.NgramIndex`), so items that can't contain
+        a query word needn't be scored. It costs memory and time to build
+        on the first query, so is worth it for large datasets that are
+        searched many times.
+
+        :param data: items to filter
+        :type data: ``list`` or ``tuple``
+        :param processes: number of processes to filter large datasets with
+        :type processes: ``int``
+        :param ngrams: index search keys by trigram
+        :type ngrams: ``Boolean``
+
+        """
         self.data = data
-        self._search_pattern_cache = {}
+        self.processes = processes or multiprocessing.cpu_count()
+        self.ngrams = ngrams
+        #: Whether the last call to :meth:`filter` ran out of time
+        self.truncated = False
+        #: :class:`~workflow.workflow.FilterProfile` of the last call to
+        #: :meth:`filter` with ``profile=True``
+        self.filter_profile = None
+        # ``(corpus, pool)`` per ``id(corpus)``, least recently used
+        # first
+        self._pools = OrderedDict()
+        # Most recently used `QueryMatcher` objects, oldest first
+        self._matchers = OrderedDict()
+        # `PreparedCorpus` per `key` function, least recently used first
+        self._corpora = OrderedDict()
+        # Indices of items in `data` that have been removed
+        self._removed = set()
+        # Whether `data` is a copy of the sequence passed in
+        self._data_copied = False
+
+    def prepare(self, key):
+        """Return :attr:`data` prepared for filtering on ``key``.
+
+        The :class:`~corpus.PreparedCorpus` is only built on the first call
+        for each ``key``, and :meth:`filter` reuses it for every query.
+        Corpora are looked up by ``key`` itself, so pass the same function
+        every time: a new ``lambda`` means preparing the data again. The
+        last :const:`CORPUS_CACHE_SIZE` corpora are kept.
+
+        :param key: function to get search key from items
+        :type key: ``callable``
+        :rtype: :class:`~corpus.PreparedCorpus`
+
+        """
+        corpus = self._corpora.pop(key, None)
+        if corpus is None:
+            corpus = PreparedCorpus(self.data, key, self.ngrams)
+            for i in self._removed:
+                corpus.remove(i)
+            if len(self._corpora) >= CORPUS_CACHE_SIZE:
+                _, old = self._corpora.popitem(last=False)
+                self._close_pool(old)
+        self._corpora[key] = corpus
+        return corpus
+
+    def add(self, item):
+        """Add ``item`` to :attr:`data`.
+
+        Every prepared corpus is updated in place, so this costs about
+        the same as preparing one item. Process pools are stopped, and
+        restarted with the new data on the next query.
+
+        :returns: index of ``item`` in :attr:`data`
+        :rtype: ``int``
+
+        """
+        self._own_data()
+        self.data.append(item)
+        for key, corpus in self._corpora.items():
+            corpus.append(item, key(item))
+        self.close()
+        return len(self.data) - 1
+
+    def update(self, index, item):
+        """Replace item ``index`` of :attr:`data` with ``item``.
+
+        Like :meth:`add`, this updates prepared corpora in place. Items
+        keep their indices, and a removed item can be updated to add it
+        back.
+
+        """
+        if not 0 <= index < len(self.data):
+            raise IndexError('item index out of range: {!r}'.format(index))
+        # Get the search keys first, so nothing changes if one fails
+        values = [(corpus, key(item)) for key, corpus in self._corpora.items()]
+        self._own_data()
+        self.data[index] = item
+        self._removed.discard(index)
+        for corpus, value in values:
+            corpus.replace(index, item, value)
+        self.close()
+
+    def remove(self, index):
+        """Remove item ``index`` from the results.
+
+        The item stays in :attr:`data`, so the indices of other items
+        don't change, but its prepared search keys are replaced with
+        empty ones that never match.
+
+        """
+        if not 0 <= index < len(self.data):
+            raise IndexError('item index out of range: {!r}'.format(index))
+        self._removed.add(index)
+        for corpus in self._corpora.values():
+            corpus.remove(index)
+        self.close()
+
+    def _own_data(self):
+        """Copy :attr:`data` before changing it, so the caller's
+        sequence isn't altered"""
+        if not self._data_copied:
+            self.data = list(self.data)
+            self._data_copied = True
 
     def filter(self, query, key=lambda x: x, ascending=False,
                include_score=False, min_score=0, max_results=0,
-               match_on=MATCH_ALL, fold_diacritics=True):
+               match_on=MATCH_ALL, fold_diacritics=True, fuzzy=False,
+               timeout=None, profile=False):
         """Fuzzy search filter. Returns list of ``items`` that match ``query``.
 
         ``query`` is case-insensitive. Any item that does not contain the
@@ -119,7 +1281,10 @@ class IterFilter(object):
         :type items: ``list`` or ``tuple``
         :param key: function to get comparison key from ``items``. Must return
                     a ``unicode`` string. The default simply returns the item.
-        :type key: ``callable``
+                    Or a list of ``(key, weight)`` tuples to match on
+                    several fields (see below). Pass the same function on
+                    every call (see :meth:`prepare`).
+        :type key: ``callable`` or ``list``
         :param ascending: set to ``True`` to get worst matches first
         :type ascending: ``Boolean``
         :param include_score: Useful for debugging the scoring algorithm.
@@ -137,6 +1302,14 @@ class IterFilter(object):
         :param fold_diacritics: Convert search keys to ASCII-only
             characters if ``query`` only contains ASCII characters.
         :type fold_diacritics: ``Boolean``
+        :param fuzzy: Score :const:`MATCH_ALLCHARS` matches with
+            :func:`fuzzy.score` (see below).
+        :type fuzzy: ``Boolean``
+        :param timeout: If not ``None``, return the results found so far
+            after this many seconds (see below).
+        :type timeout: ``float``
+        :param profile: Count and time the rules run (see below).
+        :type profile: ``Boolean``
         :returns: list of ``items`` matching ``query`` or list of
             ``(item, score, rule)`` `tuples` if ``include_score`` is ``True``.
             ``rule`` is the ``MATCH_`` rule that matched the item.
@@ -198,49 +1371,92 @@ class IterFilter(object):
         If ``query`` contains non-ASCII characters, search keys will not be
         altered.
 
-        """
-
-        # Remove preceding/trailing spaces
-        query = query.strip()
+        **Fuzzy scoring**
+
+        By default, :const:`MATCH_ALLCHARS` scores items by where the
+        leftmost match of ``query`` starts and how long it is. If
+        ``fuzzy`` is ``True``, the best-scoring match is found and scored
+        fzf-style instead, favouring characters at the starts of words and
+        runs of consecutive characters (e.g. ``gc`` ranks "Google Chrome"
+        above "Magic"). Scores stay in the same range, but it's slower
+        (see :mod:`fuzzy`).
+
+        **Timeout**
+
+        If ``timeout`` is set, the rules are run in the tiers of
+        :meth:`iter_filter`, so the cheap rules that give the best
+        matches are run on every item before the expensive ones. When
+        the time is up, the best of the results found so far are
+        returned and :attr:`truncated` is set to ``True``. (It is
+        ``False`` after every call that scored everything.) The timeout
+        only applies to scoring items, not to preparing them on the
+        first call for each ``key``.
+
+        **Multiple fields**
+
+        If ``key`` is a list of ``(key, weight)`` tuples, e.g.
+        ``[(title, 1.0), (author, 0.8)]``, each query word is matched on
+        every field and counts with its best score times the field's
+        weight, so ``tolkien hobbit`` can match author and title. All
+        fields are scored in one pass over the items (in this process,
+        and with no tiers if ``timeout`` is set). With ``include_score``,
+        results are ``(item, score, rule, field)`` tuples, where ``rule``
+        and ``field`` (the index of the field in ``key``) are those of
+        the best-scoring word.
+
+        **Profiling**
+
+        If ``profile`` is ``True``, how often each rule is run, how often
+        it matches and how long it takes are counted in a
+        :class:`~workflow.workflow.FilterProfile`, which is saved as
+        :attr:`filter_profile` and logged at ``DEBUG`` level. Profiled
+        calls run in this process and run every rule an item needs, so
+        they are slower.
 
-        results = {}
+        """
 
-        for i, item in enumerate(self.data):
-            skip = False
-            score = 0
-            words = [s.strip() for s in query.split(' ')]
-            value = key(item).strip()
-            if value == '':
-                continue
-            for word in words:
-                if word == '':
+        self.truncated = False
+        if profile:
+            profile = FilterProfile(query)
+        else:
+            profile = None
+        if isinstance(key, (list, tuple)):
+            return self._filter_fields(query, key, ascending, include_score,
+                                       min_score, max_results, match_on,
+                                       fold_diacritics, fuzzy, timeout,
+                                       profile)
+
+        corpus = self.prepare(key)
+        if timeout is None:
+            scored = self._scan(query, key, corpus, match_on, min_score,
+                                max_results, ascending, fold_diacritics,
+                                fuzzy, profile=profile)
+        else:
+            deadline = Deadline(timeout)
+            scored = []
+            done = set()
+            rules = 0
+            for tier in TIERS:
+                rules |= tier
+                if not match_on & tier:
                     continue
-                s, r = self._filter_item(value, word, match_on,
-                                         fold_diacritics)
-
-                if not s:  # Skip items that don't match part of the query
-                    skip = True
-                score += s
-
-            if skip:
-                continue
-
-            if score:
-                # use "reversed" `score` (i.e. highest becomes lowest) and
-                # `value` as sort key. This means items with the same score
-                # will be sorted in alphabetical not reverse alphabetical order
-                results[(100.0 / score, value.lower(), score)] = (item, score,
-                                                                  r)
-
-        # sort on keys, then discard the keys
-        keys = sorted(results.keys(), reverse=ascending)
-        results = [results.get(k) for k in keys]
-
-        if max_results and len(results) > max_results:
-            results = results[:max_results]
-
-        if min_score:
-            results = [r for r in results if r[1] > min_score]
+                found = self._scan(query, key, corpus, match_on & rules,
+                                   min_score, max_results, ascending,
+                                   fold_diacritics, fuzzy, done, deadline,
+                                   profile)
+                scored.extend(found)
+                done.update([t[1] for t in found])
+                if deadline.expired:
+                    self.truncated = True
+                    break
+            scored.sort(reverse=ascending)
+            if max_results:
+                scored = scored[:max_results]
+        if profile is not None:
+            self._log_profile(profile, len(corpus))
+
+        results = [(corpus.items[i], score, rule)
+                   for _, i, score, rule in scored]
 
         # return list of ``(item, score, rule)``
         if include_score:
@@ -248,111 +1464,170 @@ class IterFilter(object):
         # just return list of items
         return [t[0] for t in results]
 
-    def _filter_item(self, value, query, match_on, fold_diacritics):
-        """Filter ``value`` against ``query`` using rules ``match_on``
-
-        :returns: ``(score, rule)``
+    def _filter_fields(self, query, fields, ascending, include_score,
+                       min_score, max_results, match_on, fold_diacritics,
+                       fuzzy, timeout, profile):
+        """Implement :meth:`filter` for a list of ``(key, weight)``
+        fields"""
+        corpora = [self.prepare(key) for key, _ in fields]
+        weights = [weight for _, weight in fields]
+        words = [s.strip() for s in query.strip().split(' ') if s.strip()]
+        matchers = [self._compile(word, fold_diacritics, fuzzy)
+                    for word in words]
+        deadline = None
+        if timeout is not None:
+            deadline = Deadline(timeout)
+
+        scored = scan_fields(corpora, weights, matchers, match_on, min_score,
+                             max_results, ascending, deadline, profile)
+        self.truncated = deadline is not None and deadline.expired
+        if profile is not None:
+            self._log_profile(profile, len(corpora[0]))
+
+        items = corpora[0].items
+        if include_score:
+            return [(items[i], score, rule, field)
+                    for _, i, score, rule, field in scored]
+        return [items[t[1]] for t in scored]
+
+    def _log_profile(self, profile, items):
+        """Finish ``profile`` of a call to :meth:`filter` of ``items``
+        items, save and log it"""
+        profile.items = items
+        profile.finish()
+        self.filter_profile = profile
+        WF.logger.debug(profile.summary())
+
+    def iter_filter(self, query, key=lambda x: x, include_score=False,
+                    min_score=0, max_results=0, match_on=MATCH_ALL,
+                    fold_diacritics=True, fuzzy=False):
+        """Generate the results of :meth:`filter` tier by tier.
+
+        The rules in ``match_on`` are run in the tiers given by
+        :const:`TIERS`: first only the rules in the first tier, then
+        those in the first two, and so on. Each tier yields the items
+        that now match (best first), so the results of the cheap,
+        high-scoring rules are available before the expensive ones have
+        run, and later tiers are never run if the caller stops early.
+
+        Items are yielded once, with the same score and rule as
+        :meth:`filter` gives them. Because the tiers only roughly
+        follow scores, an item may score more than one yielded before it.
+
+        Arguments are the same as for :meth:`filter` (results are
+        always best first), but ``key`` must be a single function.
+        Generation stops after ``max_results`` items if that is non-zero.
 
         """
+        corpus = self.prepare(key)
+        # Indices of items yielded so far
+        done = set()
+        rules = 0
+        for tier in TIERS:
+            rules |= tier
+            if not match_on & tier:
+                continue
+            limit = max_results and max_results - len(done)
+            scored = self._scan(query, key, corpus, match_on & rules,
+                                min_score, limit, False, fold_diacritics,
+                                fuzzy, done)
+            for _, i, score, rule in scored:
+                done.add(i)
+                if include_score:
+                    yield (corpus.items[i], score, rule)
+                else:
+                    yield corpus.items[i]
+            if max_results and len(done) >= max_results:
+                return
+
+    def _scan(self, query, key, corpus, match_on, min_score, max_results,
+              ascending, fold_diacritics, fuzzy, skip=None, deadline=None,
+              profile=None):
+        """Run :func:`scan` on ``corpus``, in the process pool if it
+        should be used (and the call isn't being profiled)"""
+        # Remove preceding/trailing spaces
+        query = query.strip()
+        words = [s.strip() for s in query.split(' ') if s.strip()]
+        matchers = [self._compile(word, fold_diacritics, fuzzy)
+                    for word in words]
+
+        pool = None
+        if profile is None:
+            pool = self._pool(corpus)
+        if pool is None:
+            return scan(corpus, matchers, match_on, min_score, max_results,
+                        ascending, skip=skip, deadline=deadline,
+                        profile=profile)
+
+        # Each process scores a chunk, then the chunks' results
+        # are merged
+        size = len(corpus)
+        step = size // (self.processes * CHUNKS_PER_PROCESS) + 1
+        tasks = [(words, fold_diacritics, fuzzy, match_on, min_score,
+                  max_results, ascending, start, min(start + step, size),
+                  skip, deadline)
+                 for start in range(0, size, step)]
+        scored = []
+        for chunk, expired in pool.map(_scan_chunk, tasks):
+            scored.extend(chunk)
+            if expired:
+                deadline.expired = True
+        scored.sort(reverse=ascending)
+        if max_results:
+            scored = scored[:max_results]
+        return scored
+
+    def _compile(self, word, fold_diacritics, fuzzy=False):
+        """Return `QueryMatcher` for query word ``word``.
+
+        The last :const:`MATCHER_CACHE_SIZE` matchers are cached, so
+        words the user is typing are only compiled once.
 
-        query = query.lower()
-        queryset = set(query)
-
-        if not text.isascii(query):
-            fold_diacritics = False
-
-        rule = None
-        score = 0
-
-        if fold_diacritics:
-            value = text.fold_to_ascii(value)
-
-        # pre-filter any items that do not contain all characters
-        # of ``query`` to save on running several more expensive tests
-        if not queryset <= set(value.lower()):
-            return (0, None)
-
-        # item starts with query
-        if (match_on & MATCH_STARTSWITH and
-                value.lower().startswith(query)):
-            score = 100.0 - (len(value) / len(query))
-            rule = MATCH_STARTSWITH
-
-        if not score and match_on & MATCH_CAPITALS:
-            # query matches capitalised letters in item,
-            # e.g. of = OmniFocus
-            initials = ''.join([c for c in value if c in INITIALS])
-            if initials.lower().startswith(query):
-                score = 100.0 - (len(initials) / len(query))
-                rule = MATCH_CAPITALS
-
-        if not score:
-            if (match_on & MATCH_ATOM or
-                    match_on & MATCH_INITIALS_CONTAIN or
-                    match_on & MATCH_INITIALS_STARTSWITH):
-                # split the item into "atoms", i.e. words separated by
-                # spaces or other non-word characters
-                atoms = [s.lower() for s in split_on_delimiters(value)]
-                # print('atoms : %s  -->  %s' % (value, atoms))
-                # initials of the atoms
-                initials = ''.join([s[0] for s in atoms if s])
-
-            if match_on & MATCH_ATOM:
-                # is `query` one of the atoms in item?
-                # similar to substring, but scores more highly, as it's
-                # a word within the item
-                if query in atoms:
-                    score = 100.0 - (len(value) / len(query))
-                    rule = MATCH_ATOM
-
-        if not score:
-            # `query` matches start (or all) of the initials of the
-            # atoms, e.g. ``himym`` matches "How I Met Your Mother"
-            # *and* "how i met your mother" (the ``capitals`` rule only
-            # matches the former)
-            if (match_on & MATCH_INITIALS_STARTSWITH and
-                    initials.startswith(query)):
-                score = 100.0 - (len(initials) / len(query))
-                rule = MATCH_INITIALS_STARTSWITH
-
-            # `query` is a substring of initials, e.g. ``doh`` matches
-            # "The Dukes of Hazzard"
-            elif (match_on & MATCH_INITIALS_CONTAIN and
-                    query in initials):
-                score = 95.0 - (len(initials) / len(query))
-                rule = MATCH_INITIALS_CONTAIN
-
-        if not score:
-            # `query` is a substring of item
-            if match_on & MATCH_SUBSTRING and query in value.lower():
-                    score = 90.0 - (len(value) / len(query))
-                    rule = MATCH_SUBSTRING
-
-        if not score:
-            # finally, assign a score based on how close together the
-            # characters in `query` are in item.
-            if match_on & MATCH_ALLCHARS:
-                search = self._search_for_query(query)
-                match = search(value)
-                if match:
-                    score = 100.0 / ((1 + match.start()) *
-                                     (match.end() - match.start() + 1))
-                    rule = MATCH_ALLCHARS
-
-        if score > 0:
-            return (score, rule)
-        return (0, None)
-
-    def _search_for_query(self, query):
-        if query in self._search_pattern_cache:
-            return self._search_pattern_cache[query]
-
-        # Build pattern: include all characters
-        pattern = []
-        for c in query:
-            pattern.append('[^{0}]*{0}'.format(re.escape(c)))
-        pattern = ''.join(pattern)
-        search = re.compile(pattern, re.IGNORECASE).search
+        """
+        key = (word, fold_diacritics, fuzzy)
+        matcher = self._matchers.pop(key, None)
+        if matcher is None:
+            matcher = QueryMatcher(word, fold_diacritics, fuzzy)
+            if len(self._matchers) >= MATCHER_CACHE_SIZE:
+                self._matchers.popitem(last=False)
+        self._matchers[key] = matcher
+        return matcher
+
+    def _pool(self, corpus):
+        """Return process pool for ``corpus`` or ``None`` if it should
+        be filtered in this process.
+
+        The last :const:`POOL_CACHE_SIZE` pools are kept running. Older
+        ones are stopped.
 
-        self._search_pattern_cache[query] = search
-        return search
+        """
+        if self.processes < 2 or len(corpus) < PARALLEL_MIN_ITEMS:
+            return None
+        entry = self._pools.pop(id(corpus), None)
+        if entry is None:
+            # The corpus is passed to the workers once, when they start
+            # (by fork, where supported, so it isn't even pickled)
+            pool = multiprocessing.Pool(self.processes,
+                                        initializer=_init_worker,
+                                        initargs=(corpus,))
+            entry = (corpus, pool)
+            while len(self._pools) >= POOL_CACHE_SIZE:
+                _, (_, old) = self._pools.popitem(last=False)
+                old.terminate()
+                old.join()
+        self._pools[id(corpus)] = entry
+        return entry[1]
+
+    def _close_pool(self, corpus):
+        """Stop the process pool of ``corpus``, if it has one"""
+        entry = self._pools.pop(id(corpus), None)
+        if entry is not None:
+            entry[1].terminate()
+            entry[1].join()
+
+    def close(self):
+        """Stop any worker processes"""
+        for _, pool in self._pools.values():
+            pool.terminate()
+            pool.join()
+        self._pools = OrderedDict()
@@ -111,6 +111,7 @@ Or like this::
 __version__ = '1.5.1'
 
 from .workflow import Workflow, PasswordNotFound, KeychainError
+from .workflow import FilterProfile
 from .workflow import (ICON_ERROR, ICON_WARNING, ICON_NOTE, ICON_INFO,
                        ICON_FAVORITE, ICON_FAVOURITE, ICON_USER, ICON_GROUP,
                        ICON_HELP, ICON_NETWORK, ICON_WEB, ICON_COLOR,
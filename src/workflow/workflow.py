@@ -582,6 +582,76 @@ class Settings(dict):
         return ret
 
 
+class FilterProfile(object):
+    """Counts and times of the ``MATCH_*`` rules run by one filter call.
+
+    For each rule (by name, e.g. ``'startswith'``), records how many
+    times it was evaluated, how many of those it matched and how long
+    it took in total. ``'prefilter'`` is the check that an item contains
+    all the characters of the query: its hits are the items that passed.
+
+    An instance is created by :meth:`Workflow.filter` if it is called
+    with ``profile=True``, and saved as :attr:`Workflow.filter_profile`.
+
+    :param query: query being profiled
+    :type query: ``unicode``
+
+    """
+
+    def __init__(self, query):
+        self.query = query
+        #: Number of items filtered
+        self.items = 0
+        #: Total time taken by the filter call
+        self.elapsed = 0.0
+        #: Rule names in the order they were first recorded
+        self.rules = []
+        self.evaluations = {}
+        self.hits = {}
+        self.times = {}
+        self._started = time.time()
+
+    def add(self, rule, evaluations, hits, seconds):
+        """Add ``evaluations`` of ``rule`` that took ``seconds``"""
+        if rule not in self.evaluations:
+            self.rules.append(rule)
+            self.evaluations[rule] = self.hits[rule] = 0
+            self.times[rule] = 0.0
+        self.evaluations[rule] += evaluations
+        self.hits[rule] += hits
+        self.times[rule] += seconds
+
+    def record(self, rule, hit, start):
+        """Record one evaluation of ``rule`` that started at ``start``
+
+        :returns: the current time, i.e. when the next evaluation starts
+
+        """
+        now = time.time()
+        self.add(rule, 1, int(bool(hit)), now - start)
+        return now
+
+    def finish(self):
+        """Mark the filter call as finished"""
+        self.elapsed = time.time() - self._started
+
+    def summary(self):
+        """Return a table of the results for logging
+
+        :rtype: ``unicode``
+
+        """
+        lines = ['Filter profile for {!r}: {} items in {:.4f}s'.format(
+                 self.query, self.items, self.elapsed),
+                 '{:<20} {:>10} {:>10} {:>10}'.format('rule', 'evaluated',
+                                                      'hits', 'seconds')]
+        for rule in self.rules:
+            lines.append('{:<20} {:>10} {:>10} {:>10.4f}'.format(
+                         rule, self.evaluations[rule], self.hits[rule],
+                         self.times[rule]))
+        return '\n'.join(lines)
+
+
 class Workflow(object):
     """Create new :class:`Workflow` instance.
 
@@ -626,6 +696,9 @@ class Workflow(object):
         self._logger = None
         self._items = []
         self._search_pattern_cache = {}
+        #: :class:`FilterProfile` of the last call to :meth:`filter`
+        #: with ``profile=True``
+        self.filter_profile = None
         if libraries:
             sys.path = libraries + sys.path
 
@@ -1004,7 +1077,7 @@ class Workflow(object):
 
     def filter(self, query, items, key=lambda x: x, ascending=False,
                include_score=False, min_score=0, max_results=0,
-               match_on=MATCH_ALL, fold_diacritics=True):
+               match_on=MATCH_ALL, fold_diacritics=True, profile=False):
         """Fuzzy search filter. Returns list of ``items`` that match ``query``.
 
         ``query`` is case-insensitive. Any item that does not contain the
@@ -1095,6 +1168,14 @@ class Workflow(object):
         If ``query`` contains non-ASCII characters, search keys will not be
         altered.
 
+        **Profiling**
+
+        If ``profile`` is ``True``, how often each rule is run, how often
+        it matches and how long it takes are counted in a
+        :class:`FilterProfile`, which is saved as :attr:`filter_profile`
+        and logged at ``DEBUG`` level. This slows filtering down a
+        little, so is off by default.
+
         """
 
         # Remove preceding/trailing spaces
@@ -1104,6 +1185,11 @@ class Workflow(object):
         fold_diacritics = self.settings.get('__workflows_diacritic_folding',
                                             fold_diacritics)
 
+        if profile:
+            profile = FilterProfile(query)
+        else:
+            profile = None
+
         results = {}
 
         for i, item in enumerate(items):
@@ -1117,7 +1203,7 @@ class Workflow(object):
                 if word == '':
                     continue
                 s, r = self._filter_item(value, word, match_on,
-                                         fold_diacritics)
+                                         fold_diacritics, profile)
 
                 if not s:  # Skip items that don't match part of the query
                     skip = True
@@ -1143,19 +1229,32 @@ class Workflow(object):
         if min_score:
             results = [r for r in results if r[1] > min_score]
 
+        if profile is not None:
+            profile.items = len(items)
+            profile.finish()
+            self.filter_profile = profile
+            self.logger.debug(profile.summary())
+
         # return list of ``(item, score, rule)``
         if include_score:
             return results
         # just return list of items
         return [t[0] for t in results]
 
-    def _filter_item(self, value, query, match_on, fold_diacritics):
+    def _filter_item(self, value, query, match_on, fold_diacritics,
+                     profile=None):
         """Filter ``value`` against ``query`` using rules ``match_on``
 
+        If ``profile`` is a :class:`FilterProfile`, the rules run are
+        recorded in it.
+
         :returns: ``(score, rule)``
 
         """
 
+        if profile is not None:
+            t = time.time()
+
         query = query.lower()
         queryset = set(query)
 
@@ -1171,13 +1270,19 @@ class Workflow(object):
         # pre-filter any items that do not contain all characters
         # of ``query`` to save on running several more expensive tests
         if not queryset <= set(value.lower()):
+            if profile is not None:
+                profile.record('prefilter', False, t)
             return (0, None)
+        if profile is not None:
+            t = profile.record('prefilter', True, t)
 
         # item starts with query
-        if (match_on & MATCH_STARTSWITH and
-                value.lower().startswith(query)):
-            score = 100.0 - (len(value) / len(query))
-            rule = MATCH_STARTSWITH
+        if match_on & MATCH_STARTSWITH:
+            if value.lower().startswith(query):
+                score = 100.0 - (len(value) / len(query))
+                rule = MATCH_STARTSWITH
+            if profile is not None:
+                t = profile.record('startswith', score, t)
 
         if not score and match_on & MATCH_CAPITALS:
             # query matches capitalised letters in item,
@@ -1186,6 +1291,8 @@ class Workflow(object):
             if initials.lower().startswith(query):
                 score = 100.0 - (len(initials) / len(query))
                 rule = MATCH_CAPITALS
+            if profile is not None:
+                t = profile.record('capitals', score, t)
 
         if not score:
             if (match_on & MATCH_ATOM or
@@ -1205,29 +1312,39 @@ class Workflow(object):
                 if query in atoms:
                     score = 100.0 - (len(value) / len(query))
                     rule = MATCH_ATOM
+                if profile is not None:
+                    t = profile.record('atom', score, t)
 
         if not score:
             # `query` matches start (or all) of the initials of the
             # atoms, e.g. ``himym`` matches "How I Met Your Mother"
             # *and* "how i met your mother" (the ``capitals`` rule only
             # matches the former)
-            if (match_on & MATCH_INITIALS_STARTSWITH and
-                    initials.startswith(query)):
-                score = 100.0 - (len(initials) / len(query))
-                rule = MATCH_INITIALS_STARTSWITH
+            if match_on & MATCH_INITIALS_STARTSWITH:
+                if initials.startswith(query):
+                    score = 100.0 - (len(initials) / len(query))
+                    rule = MATCH_INITIALS_STARTSWITH
+                if profile is not None:
+                    t = profile.record('initials_startswith', score, t)
 
+        if not score:
             # `query` is a substring of initials, e.g. ``doh`` matches
             # "The Dukes of Hazzard"
-            elif (match_on & MATCH_INITIALS_CONTAIN and
-                    query in initials):
-                score = 95.0 - (len(initials) / len(query))
-                rule = MATCH_INITIALS_CONTAIN
+            if match_on & MATCH_INITIALS_CONTAIN:
+                if query in initials:
+                    score = 95.0 - (len(initials) / len(query))
+                    rule = MATCH_INITIALS_CONTAIN
+                if profile is not None:
+                    t = profile.record('initials_contain', score, t)
 
         if not score:
             # `query` is a substring of item
-            if match_on & MATCH_SUBSTRING and query in value.lower():
+            if match_on & MATCH_SUBSTRING:
+                if query in value.lower():
                     score = 90.0 - (len(value) / len(query))
                     rule = MATCH_SUBSTRING
+                if profile is not None:
+                    t = profile.record('substring', score, t)
 
         if not score:
             # finally, assign a score based on how close together the
@@ -1239,6 +1356,8 @@ class Workflow(object):
                     score = 100.0 / ((1 + match.start()) *
                                      (match.end() - match.start() + 1))
                     rule = MATCH_ALLCHARS
+                if profile is not None:
+                    t = profile.record('allchars', score, t)
 
         if score > 0:
             return (score, rule)